@@ -24,11 +24,17 @@
 from __future__ import with_statement
 
 from datetime import datetime
+import os
+import shutil
 import sys
+import tempfile
+import time
 
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_ as eq
+from tornado import gen
 from .couch_util import setup, teardown, with_couchdb
-from .util import with_ioloop, DatetimeEncoder
+from .util import with_ioloop, wait_for, DatetimeEncoder
 
 try:
     import json
@@ -60,6 +66,21 @@ def test_from_uri():
     eq(db.name, 'foobar')
 
 
+def test_from_uri_multiple_nodes():
+    db = trombi.from_uri(['http://1.2.3.4/foobar', 'http://1.2.3.5/foobar/'])
+    eq([x.url for x in db.server.nodes], ['http://1.2.3.4', 'http://1.2.3.5'])
+    eq(db.baseurl, 'http://1.2.3.4/foobar')
+    eq(db.name, 'foobar')
+    db.server.close()
+
+    try:
+        trombi.from_uri(['http://1.2.3.4/foo', 'http://1.2.3.5/bar'])
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
+
+
 @with_ioloop
 def test_cannot_connect(ioloop):
     def create_callback(db):
@@ -1175,6 +1196,193 @@ def test_load_view_no_such_view(baseurl, ioloop):
     ioloop.start()
 
 
+@with_ioloop
+@with_couchdb
+def test_stream_view(baseurl, ioloop):
+    batches = []
+
+    def do_test(db):
+        def bulks_cb(response):
+            eq(response.error, False)
+            db.stream_view(None, '_all_docs', stream_cb, batch_size=2,
+                           include_docs=True)
+
+        def stream_cb(result):
+            if result is not None:
+                eq(result.error, False)
+                eq(result.total_rows, 5)
+                batches.append([row['doc']['value'] for row in result])
+                return
+            eq(batches, [[0, 1], [2, 3], [4]])
+            ioloop.stop()
+
+        db.bulk_docs([{'_id': 'doc%d' % i, 'value': i} for i in range(5)],
+                     bulks_cb)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_stream_view_no_such_view(baseurl, ioloop):
+    def do_test(db):
+        def stream_cb(result):
+            eq(result.error, True)
+            eq(result.errno, trombi.errors.NOT_FOUND)
+            ioloop.stop()
+
+        db.stream_view('testview', 'all', stream_cb)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+def test_stream_view_truncated(ioloop):
+    results = []
+
+    class FakeResponse(object):
+        code = 200
+        error = None
+
+    def fake_fetch(url, callback, streaming_callback, **kwargs):
+        streaming_callback(b'{"total_rows":2,"offset":0,"rows":[\r\n'
+                           b'{"id":"a","key":"a","value":null},\r\n'
+                           b'{"id":"b","ke')
+        callback(FakeResponse())
+
+    def stream_cb(result):
+        results.append(result)
+        if result is None or result.error:
+            ioloop.stop()
+
+    s = trombi.Server('http://localhost:5984', io_loop=ioloop)
+    db = trombi.Database(s, 'testdb')
+    db._fetch = fake_fetch
+    db.stream_view(None, '_all_docs', stream_cb)
+    ioloop.start()
+
+    eq(len(results), 2)
+    eq([row['id'] for row in results[0]], ['a'])
+    eq(results[1].error, True)
+    eq(results[1].errno, trombi.errors.SERVER_ERROR)
+
+
+@with_ioloop
+@with_couchdb
+def test_iterview(baseurl, ioloop):
+    values = []
+
+    def do_test(db):
+        def bulks_cb(response):
+            eq(response.error, False)
+            rows = db.iterview(None, '_all_docs', batch_size=2,
+                               include_docs=True)
+
+            def row_cb(row):
+                if row is None:
+                    eq(values, list(range(5)))
+                    ioloop.stop()
+                    return
+                values.append(row['doc']['value'])
+                rows.next(row_cb)
+
+            rows.next(row_cb)
+
+        db.bulk_docs([{'_id': 'doc%d' % i, 'value': i} for i in range(5)],
+                     bulks_cb)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_iterview_future_limit(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        yield db.bulk_docs([{'_id': 'doc%d' % i} for i in range(5)])
+
+        rows = db.iterview(None, '_all_docs', batch_size=2, limit=3,
+                           descending=True)
+        ids = []
+        row = yield rows.next()
+        while row is not None:
+            ids.append(row['id'])
+            row = yield rows.next()
+        eq(ids, ['doc4', 'doc3', 'doc2'])
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+@with_couchdb
+def test_iterview_grouped(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        docs = [{'data': name} for name in 'abcaeb']
+        docs.append({
+            '_id': '_design/testview',
+            'language': 'javascript',
+            'views': {
+                'count': {
+                    'map': '(function (doc) { emit(doc.data, 1); })',
+                    'reduce': '_count',
+                    },
+                },
+            })
+        yield db.bulk_docs(docs)
+
+        rows = db.iterview('testview', 'count', batch_size=2, group=True)
+        counts = []
+        row = yield rows.next()
+        while row is not None:
+            counts.append((row['key'], row['value']))
+            row = yield rows.next()
+        eq(counts, [('a', 2), ('b', 2), ('c', 1), ('e', 1)])
+
+    ioloop.run_sync(do_test)
+
+
+def test_view_stream_parser():
+    body = ('{"total_rows":2,"offset":0,"rows":[\r\n'
+            '{"id":"a","key":"\u00e4","value":{"x":[1,2]}},\r\n'
+            '{"id":"b","key":"b","value":null}\r\n'
+            ']}\n').encode('utf-8')
+    parser = trombi.client._ViewStreamParser()
+    rows = []
+    # Feed byte by byte to split rows and multibyte characters
+    for i in range(len(body)):
+        rows.extend(parser.feed(body[i:i + 1]))
+    rows.extend(parser.close())
+    eq(parser.header, {'total_rows': 2, 'offset': 0})
+    eq([row['id'] for row in rows], ['a', 'b'])
+    eq(rows[0]['key'], b'\xc3\xa4'.decode('utf-8'))
+    eq(rows[0]['value'], {'x': [1, 2]})
+
+
+def test_view_stream_parser_large_row():
+    value = 'x' * 100000
+    body = ('{"total_rows":1,"offset":0,"rows":[\r\n'
+            '{"id":"a","key":"a","value":"%s"}\r\n'
+            ']}\n' % value).encode('utf-8')
+    parser = trombi.client._ViewStreamParser()
+    rows = []
+    for i in range(0, len(body), 1000):
+        rows.extend(parser.feed(body[i:i + 1000]))
+    rows.extend(parser.close())
+    eq(len(rows), 1)
+    eq(rows[0]['value'], value)
+
+
 @with_ioloop
 @with_couchdb
 def test_temporary_view_empty_results(baseurl, ioloop):
@@ -1548,6 +1756,71 @@ def test_view_results_include_docs_with_bogus_docs(baseurl, ioloop):
     ioloop.start()
 
 
+def test_view_result_rows():
+    result = trombi.ViewResult({
+        'total_rows': 2,
+        'rows': [
+            {'id': 'a', 'key': 1, 'value': None, 'doc': {'_id': 'a'}},
+            {'key': 'b', 'error': 'not_found'},
+            ]
+        })
+    row = result[0]
+    assert isinstance(row, trombi.ViewRow)
+    assert row is result[0]
+    assert isinstance(row['doc'], trombi.Document)
+    assert row['doc'] is list(result)[0]['doc']
+    eq(row['doc'].id, 'a')
+
+    eq(result[1], {'key': 'b', 'error': 'not_found'})
+    eq(result[1].get('doc'), None)
+    assert 'id' not in result[1]
+
+    del row['doc']
+    eq(result[0], {'id': 'a', 'key': 1, 'value': None})
+
+
+def test_document_reserved_fields():
+    data = {'_id': 'a', '_rev': '1-abc', '_conflicts': ['1-def'], 'x': 1}
+    doc = trombi.Document(None, data)
+    eq(doc.id, 'a')
+    eq(doc.rev, '1-abc')
+    eq(doc.conflicts, ['1-def'])
+    eq(dict(doc), {'x': 1})
+    # The given data is not modified
+    eq(data['_id'], 'a')
+    assert not hasattr(doc, 'deleted')
+
+    raw = doc.raw()
+    eq(raw, {'_id': 'a', '_rev': '1-abc', 'x': 1})
+    raw['y'] = 2
+    doc['z'] = 3
+    doc.rev = '2-abc'
+    eq(doc.raw(), {'_id': 'a', '_rev': '2-abc', 'x': 1, 'z': 3})
+
+
+def test_view_result_to_columns():
+    if trombi.client.numpy is None:
+        raise SkipTest('NumPy not installed')
+
+    result = trombi.ViewResult({
+        'rows': [
+            {'id': 'a', 'key': ['x', 1], 'value': 1},
+            {'id': 'b', 'key': ['y', 2], 'value': 2.5},
+            ]
+        })
+    columns = result.to_columns()
+    eq(list(columns['id']), ['a', 'b'])
+    eq(list(columns['key']), [['x', 1], ['y', 2]])
+    eq(columns['value'].dtype.kind, 'f')
+    eq(columns['value'].sum(), 3.5)
+
+    columns = result.to_columns(dtype='int32')
+    eq(str(columns['value'].dtype), 'int32')
+
+    reduced = trombi.ViewResult({'rows': [{'key': None, 'value': 3}]})
+    assert 'id' not in reduced.to_columns()
+
+
 @with_ioloop
 @with_couchdb
 def test_bulk_insert(baseurl, ioloop):
@@ -1730,6 +2003,68 @@ def test_continuous_changes_feed(baseurl, ioloop):
     ioloop.start()
 
 
+def test_changes_line_buffer():
+    data = b'{"seq":1}\n\n{"seq":2,"id":"\xc3\xa4"}\n{"last_seq":2}\n'
+    for size in (1, 3, len(data)):
+        buf = trombi.client._LineBuffer()
+        lines = []
+        for i in range(0, len(data), size):
+            lines.extend(buf.feed(data[i:i + size]))
+        eq(lines, [b'{"seq":1}', b'{"seq":2,"id":"\xc3\xa4"}',
+                   b'{"last_seq":2}'])
+
+
+@with_ioloop
+@with_couchdb
+def test_continuous_changes_feed_close(baseurl, ioloop):
+    def do_test(db):
+        def _got_change(change):
+            if change is None:
+                eq(feed.closed, True)
+                ioloop.stop()
+                return
+            eq(change['id'], 'mydoc')
+            eq(feed.last_seq, change['seq'])
+            feed.close()
+
+        feed = db.changes(_got_change, feed='continuous', heartbeat=100)
+        db.set('mydoc', {'some': 'data'}, lambda x: None)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_continuous_changes_feed_batch(baseurl, ioloop):
+    def do_test(db):
+        changes = []
+
+        def _got_batch(batch):
+            if batch is None:
+                ioloop.stop()
+                return
+            assert isinstance(batch, trombi.ChangesBatch)
+            changes.extend(batch)
+            eq(batch.last_seq, batch[-1]['seq'])
+            if len(changes) == 3:
+                eq([c['id'] for c in changes], ['doc0', 'doc1', 'doc2'])
+                feed.close()
+
+        def docs_created(result):
+            assert not result.error
+
+        feed = db.changes(_got_batch, feed='continuous', heartbeat=100,
+                          batch_window=0.5)
+        db.bulk_docs([{'_id': 'doc%d' % i} for i in range(3)],
+                     docs_created)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
 @with_ioloop
 @with_couchdb
 def test_long_polling_changes_feed(baseurl, ioloop):
@@ -1789,6 +2124,33 @@ def test_custom_encoder_from_uri():
     json.dumps({'foo': datetime.now()}, cls=db._json_encoder)
 
 
+def test_custom_encoder_uses_json_codec():
+    s = trombi.Server('http://localhost:5984', json_encoder=DatetimeEncoder)
+    assert type(s.codec) is trombi.JSONCodec
+    s.codec.dumps({'foo': datetime.now()})
+
+
+def test_json_codecs():
+    codecs = [trombi.JSONCodec()]
+    if trombi.orjson is not None:
+        codecs.append(trombi.OrjsonCodec())
+    if trombi.ujson is not None:
+        codecs.append(trombi.UjsonCodec())
+
+    data = {'foo': [1, 2.5, None, True], 'bar': {'baz': 'qu\u00e4x'}}
+    for codec in codecs:
+        encoded = codec.dumps(data)
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode('utf-8')
+        eq(codec.loads(encoded), data)
+
+        # Integers too large for the fast codecs fall back to json
+        encoded = codec.dumps({'big': 2 ** 70})
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode('utf-8')
+        eq(json.loads(encoded), {'big': 2 ** 70})
+
+
 @with_ioloop
 @with_couchdb
 def test_create_document_with_custom_encoder(baseurl, ioloop):
@@ -1810,3 +2172,926 @@ def test_create_document_with_custom_encoder(baseurl, ioloop):
     s = trombi.Server(baseurl, io_loop=ioloop, json_encoder=DatetimeEncoder)
     s.create('testdb', callback=create_db_callback)
     ioloop.start()
+
+
+@with_ioloop
+def test_connection_pool_limits_host_connections(ioloop):
+    pool = trombi.ConnectionPool(ioloop, max_host_connections=2)
+    started = []
+
+    for i in range(3):
+        pool.acquire('localhost:5984', lambda i=i: started.append(i))
+
+    eq(started, [0, 1])
+    eq(pool.stats(), {'in_use': 2, 'waiting': 1})
+
+    pool.release('localhost:5984')
+    ioloop.add_callback(ioloop.stop)
+    ioloop.start()
+    eq(started, [0, 1, 2])
+    eq(pool.stats('localhost:5984'), {'in_use': 2, 'waiting': 0})
+
+    pool.release('localhost:5984')
+    eq(pool.stats(), {'in_use': 1, 'waiting': 0})
+
+    pool.acquire('localhost:5984', lambda: started.append(3))
+    eq(started, [0, 1, 2, 3])
+    eq(pool.stats(), {'in_use': 2, 'waiting': 0})
+
+    pool.release('localhost:5984')
+    pool.release('localhost:5984')
+    eq(pool.stats(), {'in_use': 0, 'waiting': 0})
+    eq(pool.stats('localhost:5984'), {'in_use': 0, 'waiting': 0})
+
+
+@with_ioloop
+def test_pooled_server_has_own_client(ioloop):
+    s = trombi.Server('http://localhost:5984', io_loop=ioloop)
+    other = trombi.Server('http://localhost:5984', io_loop=ioloop)
+    pooled = trombi.Server('http://localhost:5984', io_loop=ioloop,
+                           max_host_connections=50)
+    assert other._client is s._client
+    assert pooled._client is not s._client
+
+
+@with_ioloop
+@with_couchdb
+def test_pooled_requests(baseurl, ioloop):
+    s = trombi.Server(baseurl, io_loop=ioloop, max_host_connections=1)
+    results = []
+
+    def do_test(db):
+        def got_doc(doc):
+            results.append(doc)
+            if len(results) == 3:
+                assert all(x is None for x in results)
+                eq(s.pool.stats()['in_use'], 0)
+                ioloop.stop()
+
+        for i in range(3):
+            db.get('doc%d' % i, got_doc)
+        eq(s.pool.stats()['waiting'], 2)
+
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_failing_node_is_skipped(baseurl, ioloop):
+    s = trombi.Server(['http://localhost:39998', baseurl], io_loop=ioloop)
+
+    def first_callback(result):
+        eq(result.error, True)
+        eq(result.errno, 599)
+        eq(s.nodes[0].healthy, False)
+        s.create('testdb', callback=second_callback)
+
+    def second_callback(db):
+        eq(db.error, False)
+        eq(db.name, 'testdb')
+        assert s.nodes[1].latency is not None
+        s.close()
+        ioloop.stop()
+
+    s.create('testdb', callback=first_callback)
+    ioloop.start()
+
+
+def test_retry_policy():
+    policy = trombi.RetryPolicy(max_attempts=3, backoff_base=1,
+                                backoff_max=3, jitter=False)
+    assert policy.should_retry('GET', 599, 1)
+    assert policy.should_retry('PUT', 503, 2)
+    assert not policy.should_retry('GET', 599, 3)
+    assert not policy.should_retry('POST', 599, 1)
+    assert not policy.should_retry('GET', 404, 1)
+    eq([policy.delay(x) for x in (1, 2, 3)], [1, 2, 3])
+
+    policy = trombi.RetryPolicy(backoff_base=1, backoff_max=3)
+    assert all(0 <= policy.delay(x) <= 3 for x in range(1, 10))
+
+
+def test_database_retry_policy():
+    s = trombi.Server('http://localhost:5984')
+    db = trombi.Database(s, 'testdb')
+    requests = []
+    s._fetch = lambda url, callback, **kwargs: requests.append(kwargs)
+    db.info(lambda info: None)
+    policy = trombi.RetryPolicy(max_attempts=10)
+    db.retry_policy = policy
+    db.info(lambda info: None)
+    assert 'retry_policy' not in requests[0]
+    assert requests[1]['retry_policy'] is policy
+
+
+@with_ioloop
+@with_couchdb
+def test_retry_on_another_node(baseurl, ioloop):
+    policy = trombi.RetryPolicy(backoff_base=0)
+    s = trombi.Server(['http://localhost:39998', baseurl], io_loop=ioloop,
+                      retry_policy=policy)
+
+    def create_callback(db):
+        eq(db.error, False)
+        eq(db.name, 'testdb')
+        eq(s.nodes[0].healthy, False)
+        s.close()
+        ioloop.stop()
+
+    s.create('testdb', callback=create_callback)
+    ioloop.start()
+
+
+def test_circuit_breaker():
+    breaker = trombi.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    eq(breaker.state, trombi.CircuitBreaker.CLOSED)
+    breaker.record(False)
+    eq(breaker.state, trombi.CircuitBreaker.OPEN)
+    eq(breaker.allow(), False)
+
+    breaker = trombi.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record(False)
+    eq(breaker.state, trombi.CircuitBreaker.OPEN)
+    eq(breaker.allow(), True)
+    eq(breaker.state, trombi.CircuitBreaker.HALF_OPEN)
+    eq(breaker.allow(), False)
+    breaker.record(True)
+    eq(breaker.state, trombi.CircuitBreaker.CLOSED)
+
+
+def test_circuit_breaker_error_rate():
+    breaker = trombi.CircuitBreaker(failure_threshold=10, error_rate=0.5,
+                                    window=4)
+    for success in (True, False, True):
+        breaker.record(success)
+    eq(breaker.state, trombi.CircuitBreaker.CLOSED)
+    breaker.record(False)
+    eq(breaker.state, trombi.CircuitBreaker.OPEN)
+
+
+def test_closed_feed_is_not_a_node_failure():
+    class FakeResponse(object):
+        code = 599
+
+    s = trombi.Server('http://localhost:5984',
+                      circuit_breaker={'failure_threshold': 1})
+    s._send = lambda url, callback, fetch_args: callback(FakeResponse())
+    responses = []
+    s._fetch('%s/testdb/_changes' % s.baseurl, responses.append,
+             streaming_callback=lambda data: None)
+    eq(responses[0].code, 599)
+    eq(s.nodes[0].healthy, True)
+    eq(s.nodes[0].breaker.state, trombi.CircuitBreaker.CLOSED)
+
+
+@with_ioloop
+def test_circuit_open(ioloop):
+    s = trombi.Server('http://localhost:39998', io_loop=ioloop,
+                      circuit_breaker={'failure_threshold': 1})
+
+    def first_callback(result):
+        eq(result.error, True)
+        eq(result.errno, 599)
+        s.create('couchdb-database', callback=second_callback)
+
+    def second_callback(result):
+        eq(result.error, True)
+        eq(result.errno, trombi.errors.CIRCUIT_OPEN)
+        ioloop.stop()
+
+    s.create('couchdb-database', callback=first_callback)
+    ioloop.start()
+
+
+@with_ioloop
+def test_request_scheduler(ioloop):
+    scheduler = trombi.RequestScheduler(
+        ioloop, 1, queue_limits={trombi.PRIORITY_BULK: 1})
+    started = []
+    rejected = []
+
+    def submit(name, priority):
+        scheduler.submit(priority,
+                         lambda: started.append(name),
+                         lambda: rejected.append(name))
+
+    submit('first', trombi.PRIORITY_INTERACTIVE)
+    submit('bulk', trombi.PRIORITY_BULK)
+    submit('rejected', trombi.PRIORITY_BULK)
+    submit('interactive', trombi.PRIORITY_INTERACTIVE)
+    eq(started, ['first'])
+    eq(rejected, ['rejected'])
+    eq(scheduler.stats(), {'in_flight': 1, 'queued': {
+                trombi.PRIORITY_INTERACTIVE: 1, trombi.PRIORITY_BULK: 1}})
+
+    def release():
+        scheduler.release()
+        if len(started) < 3:
+            ioloop.add_callback(release)
+        else:
+            ioloop.stop()
+
+    ioloop.add_callback(release)
+    ioloop.start()
+    eq(started, ['first', 'interactive', 'bulk'])
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_queue_full(baseurl, ioloop):
+    s = trombi.Server(baseurl, io_loop=ioloop, max_in_flight=1,
+                      queue_limits={trombi.PRIORITY_BULK: 0})
+
+    def do_test(db):
+        def get_callback(doc):
+            eq(doc, None)
+            eq(s.scheduler.stats()['in_flight'], 0)
+            ioloop.stop()
+
+        def bulk_callback(result):
+            eq(result.error, True)
+            eq(result.errno, trombi.errors.QUEUE_FULL)
+
+        db.get('nonexistent', get_callback)
+        db.bulk_docs([{'some': 'data'}], bulk_callback)
+
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_compressed_bulk_insert(baseurl, ioloop):
+    def do_test(db):
+        def bulks_cb(response):
+            assert not response.error
+            eq(len(response), 10)
+            db.get('doc5', get_cb)
+
+        def get_cb(doc):
+            eq(doc['value'], 'x' * 100)
+            ioloop.stop()
+
+        datas = [{'_id': 'doc%d' % i, 'value': 'x' * 100} for i in range(10)]
+        db.bulk_docs(datas, bulks_cb)
+
+    s = trombi.Server(baseurl, io_loop=ioloop, compression=True,
+                      compress_threshold=0)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_futures(baseurl, ioloop):
+    s = trombi.Server(baseurl, io_loop=ioloop)
+
+    @gen.coroutine
+    def do_test():
+        db = yield s.create('testdb')
+        doc = yield db.set('mydoc', {'some': 'data'})
+        eq(doc.id, 'mydoc')
+
+        docs = yield [db.get('mydoc'), db.get('nonexistent')]
+        eq(docs[0]['some'], 'data')
+        eq(docs[1], None)
+
+        try:
+            yield db.set('mydoc', {'other': 'data'})
+        except trombi.errors.Conflict as e:
+            eq(e.errno, trombi.errors.CONFLICT)
+        else:
+            assert False, 'Conflict not raised'
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+def test_future_invalid_db_name(ioloop):
+    s = trombi.Server('http://localhost:39998', io_loop=ioloop)
+    future = s.create('this name is invalid')
+    assert future.done()
+    try:
+        future.result()
+    except trombi.errors.InvalidDatabaseName as e:
+        eq(e.errno, trombi.errors.INVALID_DATABASE_NAME)
+    else:
+        assert False, 'InvalidDatabaseName not raised'
+
+
+@with_ioloop
+@with_couchdb
+def test_document_loader(baseurl, ioloop):
+    def do_test(db):
+        docs = []
+
+        def bulks_cb(response):
+            assert not response.error
+            db.loader = trombi.DocumentLoader(db)
+            for doc_id in ('doc1', 'nonexistent', 'doc2', 'doc1', 'empty'):
+                db.get(doc_id, got_doc)
+
+        def got_doc(doc):
+            docs.append(doc)
+            if len(docs) < 5:
+                return
+            eq(docs[0]['value'], 1)
+            eq(docs[1], None)
+            eq(docs[2]['value'], 2)
+            eq(docs[3].id, 'doc1')
+            assert docs[0] is not docs[3]
+            # A document without fields of its own still exists
+            eq(docs[4].id, 'empty')
+            assert docs[4].rev
+            ioloop.stop()
+
+        db.bulk_docs([{'_id': 'doc1', 'value': 1},
+                      {'_id': 'doc2', 'value': 2},
+                      {'_id': 'empty'}], bulks_cb)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_writer(baseurl, ioloop):
+    def do_test(db):
+        results = []
+
+        def doc_saved(result):
+            results.append(result)
+            if len(results) < 3:
+                return
+            eq(results[0].id, 'doc1')
+            assert results[0].rev
+            eq(results[1]['value'], 2)
+            assert results[1].id
+            eq(results[2].error, True)
+            eq(results[2].errno, trombi.errors.CONFLICT)
+            ioloop.stop()
+
+        writer = trombi.BulkWriter(db, max_docs=3, delay=60)
+        db.writer = writer
+        db.set('doc1', {'value': 1}, doc_saved)
+        db.set({'value': 2}, doc_saved)
+        eq(len(writer._pending), 2)
+        db.set('doc1', {'value': 3}, doc_saved)
+        eq(len(writer._pending), 0)
+
+    s = trombi.Server(baseurl, io_loop=ioloop)
+    s.create('testdb', callback=do_test)
+    ioloop.start()
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_writer_future(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        db.writer = trombi.BulkWriter(db, max_docs=2, delay=60)
+        docs = yield [db.set({'value': 1}), db.set('doc2', {'value': 2})]
+        eq(docs[0]['value'], 1)
+        assert docs[0].id
+        assert docs[0].rev
+        eq(docs[1].id, 'doc2')
+        assert docs[1].rev
+
+    ioloop.run_sync(do_test)
+
+
+def test_document_dirty():
+    doc = trombi.Document(None, {'value': 1})
+    eq(doc.dirty, True)
+
+    doc = trombi.Document._from_json(
+        None, {'_id': 'a', '_rev': '1-abc', 'value': 1, 'tags': []})
+    eq(doc.dirty, False)
+    eq(doc['value'], 1)
+    eq(doc.dirty, False)
+    doc['tags'].append('new')
+    eq(doc.dirty, True)
+
+    doc.dirty = False
+    doc['value'] = 2
+    eq(doc.dirty, True)
+
+
+@with_ioloop
+@with_couchdb
+def test_set_changed_only(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        doc = yield db.set('doc1', {'value': 1})
+        eq(doc.dirty, False)
+        rev = doc.rev
+
+        doc = yield db.set(doc, changed_only=True)
+        eq(doc.rev, rev)
+
+        doc['value'] = 2
+        doc = yield db.set(doc, changed_only=True)
+        assert doc.rev != rev
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_docs_changed_only(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        docs = [trombi.Document(db, {'value': i}) for i in range(3)]
+        yield db.bulk_docs(docs)
+        revs = [doc.rev for doc in docs]
+        assert all(revs)
+        assert not any(doc.dirty for doc in docs)
+
+        docs[1]['value'] = 10
+        result = yield db.bulk_docs(docs, changed_only=True)
+        eq(len(result), 3)
+        eq([item['id'] for item in result], [doc.id for doc in docs])
+        eq(result[0]['rev'], revs[0])
+        eq(result[2]['rev'], revs[2])
+        assert result[1]['rev'] != revs[1]
+        eq(docs[1].rev, result[1]['rev'])
+
+        result = yield db.bulk_docs(docs, changed_only=True)
+        eq([item['rev'] for item in result], [doc.rev for doc in docs])
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+@with_couchdb
+def test_bulk_docs_changed_only_mixed(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        doc = yield db.set('clean', {'value': 1})
+
+        result = yield db.bulk_docs([{'_id': 'plain', 'value': 2}, doc],
+                                    changed_only=True)
+        eq(len(result), 2)
+        eq(result[0]['id'], 'plain')
+        assert result[0]['rev']
+        eq(result[1]['id'], 'clean')
+        eq(result[1]['rev'], doc.rev)
+
+    ioloop.run_sync(do_test)
+
+
+def test_document_cache_eviction():
+    cache = trombi.DocumentCache(max_docs=2, max_bytes=10)
+    cache.store('a', '"1-a"', b'aaaa')
+    cache.store('b', '"1-b"', b'bbbb')
+    eq(cache.lookup('a'), ('"1-a"', b'aaaa'))
+    # b is the least recently used
+    cache.store('c', '"1-c"', b'cc')
+    assert 'b' not in cache
+    eq(len(cache), 2)
+    cache.store('d', '"1-d"', b'dddddd')
+    eq(sorted(cache._entries), ['c', 'd'])
+    eq(cache.stats()['bytes'], 8)
+    cache.invalidate('c')
+    eq(cache.stats()['bytes'], 6)
+
+
+@with_ioloop
+@with_couchdb
+def test_document_cache(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        db.cache = trombi.DocumentCache()
+        yield db.set('doc1', {'value': 1})
+
+        doc = yield db.get('doc1')
+        eq(doc['value'], 1)
+        eq((db.cache.hits, db.cache.misses), (0, 1))
+
+        other = yield db.get('doc1')
+        eq(other['value'], 1)
+        assert other is not doc
+        eq((db.cache.hits, db.cache.misses), (1, 1))
+
+        doc['value'] = 2
+        yield db.set(doc)
+        assert 'doc1' not in db.cache
+        doc = yield db.get('doc1')
+        eq(doc['value'], 2)
+
+        yield db.delete(doc)
+        doc = yield db.get('doc1')
+        eq(doc, None)
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+@with_couchdb
+def test_cache_invalidator(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        db.cache = trombi.DocumentCache()
+        yield db.set('doc1', {'value': 1})
+
+        invalidator = trombi.CacheInvalidator(db)
+        invalidator.start()
+        yield wait_for(ioloop, lambda: db.cache.coherent)
+
+        yield db.get('doc1')
+        doc = yield db.get('doc1')
+        eq(doc['value'], 1)
+        eq((db.cache.hits, db.cache.misses), (1, 1))
+
+        # Another client modifies the document
+        other = yield trombi.Server(baseurl, io_loop=ioloop).get('testdb')
+        doc = yield other.get('doc1')
+        doc['value'] = 2
+        yield other.set(doc)
+
+        yield wait_for(ioloop, lambda: 'doc1' not in db.cache)
+        doc = yield db.get('doc1')
+        eq(doc['value'], 2)
+        assert invalidator.last_seq
+
+        invalidator.stop()
+        eq(db.cache.coherent, False)
+
+    ioloop.run_sync(do_test)
+
+
+def test_cache_invalidator_inflight_get():
+    class FakeResponse(object):
+        code = 200
+        headers = {'Etag': '"1-a"'}
+        body = b'{"_id": "x", "_rev": "1-a"}'
+
+    s = trombi.Server('http://localhost:5984')
+    db = trombi.Database(s, 'testdb')
+    db.cache = trombi.DocumentCache()
+    requests = []
+    db._fetch = lambda url, callback, **kwargs: requests.append(callback)
+    docs = []
+    db.get('x', docs.append)
+
+    # The change arrives before the response to the GET sent earlier
+    trombi.CacheInvalidator(db)._change({'seq': 2, 'id': 'x'})
+    requests[0](FakeResponse())
+    eq(docs[0].rev, '1-a')
+    assert 'x' not in db.cache
+
+
+@with_ioloop
+@with_couchdb
+def test_view_cache(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        yield db.set('doc1', {'value': 1})
+        db.view_cache = trombi.ViewCache(ttl=60)
+
+        result = yield db.view(None, '_all_docs', include_docs=True)
+        eq(result[0]['doc']['value'], 1)
+        eq((db.view_cache.hits, db.view_cache.misses), (0, 1))
+
+        result = yield db.view(None, '_all_docs', include_docs=True)
+        eq(result[0]['doc']['value'], 1)
+        eq((db.view_cache.hits, db.view_cache.misses), (1, 1))
+
+        # A different query is not served from the cache
+        result = yield db.view(None, '_all_docs', keys=['doc1'])
+        eq(result[0]['id'], 'doc1')
+        eq((db.view_cache.hits, db.view_cache.misses), (1, 2))
+
+        # Expired results are revalidated
+        db.view_cache.ttl = 0
+        db.view_cache.clear()
+        yield db.view(None, '_all_docs')
+        yield db.view(None, '_all_docs')
+        eq((db.view_cache.hits, db.view_cache.misses), (2, 3))
+
+    ioloop.run_sync(do_test)
+
+
+def test_view_cache_keys_headers():
+    s = trombi.Server('http://localhost:5984')
+    db = trombi.Database(s, 'testdb')
+    db.view_cache = trombi.ViewCache()
+    requests = []
+    db._fetch = lambda url, callback, **kwargs: requests.append(kwargs)
+    db.view(None, '_all_docs', lambda result: None, keys=['doc1'])
+    eq(requests[0]['method'], 'POST')
+    eq(requests[0]['headers']['Content-Type'], 'application/json')
+
+
+def test_file_checkpoint():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        checkpoint = trombi.FileCheckpoint(os.path.join(tmpdir, 'seq'))
+        results = []
+        checkpoint.load(results.append)
+        checkpoint.save('12-abc', results.append)
+        checkpoint.load(results.append)
+        eq(results[0], None)
+        eq(results[1].error, False)
+        eq(results[2], '12-abc')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@with_ioloop
+@with_couchdb
+def test_changes_follower(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        checkpoint = trombi.LocalDocCheckpoint(db, 'follower')
+        seen = []
+
+        follower = trombi.ChangesFollower(db, seen.append,
+                                          checkpoint=checkpoint)
+        follower.start()
+        yield db.set('doc1', {})
+        yield wait_for(ioloop, lambda: len(seen) == 1)
+        follower.stop()
+        yield wait_for(ioloop, lambda: follower.saved_seq == seen[0]['seq'])
+
+        yield db.set('doc2', {})
+        follower = trombi.ChangesFollower(db, seen.append,
+                                          checkpoint=checkpoint)
+        follower.start()
+        yield wait_for(ioloop, lambda: len(seen) == 2)
+        eq(seen[1]['id'], 'doc2')
+        follower.stop()
+
+    ioloop.run_sync(do_test)
+
+
+def test_continuous_feed_has_no_request_timeout():
+    s = trombi.Server('http://localhost:5984')
+    db = trombi.Database(s, 'testdb')
+    requests = []
+    db._fetch = lambda url, callback, **kwargs: requests.append(kwargs)
+    s._fetch = lambda url, callback, **kwargs: requests.append(kwargs)
+    db.changes(lambda change: None, feed='continuous')
+    s.db_updates(lambda update: None, feed='continuous')
+    eq([kwargs['request_timeout'] for kwargs in requests], [0, 0])
+
+
+@with_ioloop
+def test_changes_follower_backoff(ioloop):
+    s = trombi.Server('http://localhost:5984', io_loop=ioloop)
+    db = trombi.Database(s, 'testdb')
+    feeds = []
+
+    def changes(callback, **kwargs):
+        feeds.append(trombi.ChangesFeed(s, callback))
+        return feeds[-1]
+
+    db.changes = changes
+    error = trombi.TrombiErrorResponse(599, 'Connection closed')
+    follower = trombi.ChangesFollower(db, None)
+    follower.start()
+
+    feeds[-1].callback(error)
+    eq(follower._failures, 1)
+    follower._connect()
+    feeds[-1].callback(error)
+    eq(follower._failures, 2)
+
+    # A feed that received data worked, so the backoff starts anew
+    follower._connect()
+    feeds[-1]._stream(b'\n')
+    feeds[-1].callback(error)
+    eq(follower._failures, 1)
+    follower.stop()
+
+
+@with_ioloop
+def test_changes_processor(ioloop):
+    handled = []
+    checkpoints = []
+
+    @gen.coroutine
+    def handler(change):
+        # Changes of doc a take longer than those of doc b
+        delay = 0.05 if change['id'] == 'a' else 0.01
+        yield gen.Task(ioloop.add_timeout, time.time() + delay)
+        handled.append(change['seq'])
+
+    def on_checkpoint(seq):
+        checkpoints.append(seq)
+        if seq == 4:
+            ioloop.stop()
+
+    processor = trombi.ChangesProcessor(handler, concurrency=2,
+                                        on_checkpoint=on_checkpoint,
+                                        io_loop=ioloop)
+    batch = trombi.ChangesBatch([
+        {'seq': 1, 'id': 'a'},
+        {'seq': 2, 'id': 'a'},
+        {'seq': 3, 'id': 'b'},
+        {'seq': 4, 'id': 'b'},
+        ])
+    processor.submit(batch)
+    eq(processor.pending, 4)
+    ioloop.start()
+
+    eq(handled, [3, 4, 1, 2])
+    eq(checkpoints, [1, 4])
+    eq(processor.pending, 0)
+
+
+@with_ioloop
+def test_changes_processor_failure(ioloop):
+    handled = []
+    checkpoints = []
+    failing = set([1])
+
+    def handler(change):
+        if change['seq'] in failing:
+            raise ValueError('failed')
+        handled.append(change['seq'])
+
+    processor = trombi.ChangesProcessor(handler,
+                                        on_checkpoint=checkpoints.append,
+                                        io_loop=ioloop)
+
+    @gen.coroutine
+    def do_test():
+        processor.submit(trombi.ChangesBatch([
+            {'seq': 1, 'id': 'a'},
+            {'seq': 2, 'id': 'b'},
+            {'seq': 3, 'id': 'a'},
+            ]))
+        yield wait_for(ioloop, lambda: processor.running == 0)
+        # The change of doc b is handled, but the checkpoint stays
+        # before the failed change and doc a waits behind it
+        eq(handled, [2])
+        eq(checkpoints, [])
+        eq(processor.failed, [{'seq': 1, 'id': 'a'}])
+        eq(processor.pending, 3)
+
+        failing.clear()
+        processor.retry()
+        yield wait_for(ioloop, lambda: processor.pending == 0)
+        eq(handled, [2, 1, 3])
+        eq(checkpoints, [2, 3])
+        eq(processor.failed, [])
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+def test_changes_processor_on_error(ioloop):
+    handled = []
+    checkpoints = []
+    errors = []
+
+    def handler(change):
+        if change['seq'] == 1 and not errors:
+            raise ValueError('failed')
+        handled.append(change['seq'])
+
+    def on_error(change, error):
+        errors.append((change['seq'], str(error)))
+        return True
+
+    processor = trombi.ChangesProcessor(handler,
+                                        on_checkpoint=checkpoints.append,
+                                        on_error=on_error, io_loop=ioloop)
+
+    @gen.coroutine
+    def do_test():
+        processor.submit([{'seq': 1, 'id': 'a'}, {'seq': 2, 'id': 'b'}])
+        yield wait_for(ioloop, lambda: processor.pending == 0)
+        eq(errors, [(1, 'failed')])
+        eq(sorted(handled), [1, 2])
+        eq(checkpoints[-1], 2)
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+@with_couchdb
+def test_continuous_changes_feed_max_queue(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        changes = []
+
+        feed = db.changes(changes.append, feed='continuous',
+                          heartbeat=100, max_queue=2)
+        feed.pause()
+        yield db.bulk_docs([{'_id': 'doc%d' % i} for i in range(5)])
+        yield wait_for(ioloop, lambda: feed.overflowed)
+        eq(feed.queued, 2)
+        eq(changes, [])
+
+        feed.resume()
+        yield wait_for(ioloop, lambda: len(changes) == 3)
+        eq([change['id'] for change in changes[:2]], ['doc0', 'doc1'])
+        eq(changes[2].error, True)
+        eq(changes[2].errno, trombi.errors.QUEUE_FULL)
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+@with_couchdb
+def test_changes_multiplexer(baseurl, ioloop):
+    @gen.coroutine
+    def do_test():
+        s = trombi.Server(baseurl, io_loop=ioloop)
+        db = yield s.create('testdb')
+        other = yield s.create('testdb2')
+        yield db.set('doc1', {})
+        changes = []
+
+        def _got_changes(name, batch):
+            changes.extend((name, change['id']) for change in batch)
+
+        mux = trombi.ChangesMultiplexer(s, _got_changes, max_connections=1,
+                                        since={'testdb': 0})
+        mux.start()
+        # testdb is caught up on start
+        yield wait_for(ioloop, lambda: len(changes) == 1)
+        eq(changes, [('testdb', 'doc1')])
+
+        # Updates are pushed through _db_updates
+        mux.updated('testdb2')
+        yield other.set('doc2', {})
+        mux.updated('testdb2')
+        yield wait_for(ioloop, lambda: len(changes) == 2)
+        eq(changes[1], ('testdb2', 'doc2'))
+        assert mux.seqs['testdb2']
+        mux.stop()
+
+    ioloop.run_sync(do_test)
+
+
+@with_ioloop
+def test_changes_multiplexer_reconnect(ioloop):
+    s = trombi.Server('http://localhost:5984', io_loop=ioloop)
+    feeds = []
+
+    class FakeFeed(object):
+        def close(self):
+            pass
+
+    def db_updates(callback, **params):
+        feeds.append((callback, params))
+        return FakeFeed()
+
+    def reconnect(mux, update):
+        mux.updated = lambda name, type='updated': updated.append(name)
+        callback, params = feeds[-1]
+        callback(trombi.TrombiDict(update))
+        callback(None)
+        ioloop.run_sync(lambda: wait_for(ioloop, lambda: len(feeds) == 2))
+        return feeds[-1][1]
+
+    s.db_updates = db_updates
+
+    # The feed continues from the seq of the last update
+    updated = []
+    mux = trombi.ChangesMultiplexer(s, None)
+    mux.start()
+    assert 'since' not in feeds[0][1]
+    mux.seqs['testdb2'] = 1
+    params = reconnect(mux, {'db_name': 'testdb', 'type': 'updated',
+                             'seq': '3-abc'})
+    eq(params['since'], '3-abc')
+    eq(updated, ['testdb'])
+    mux.stop()
+
+    # Without seqs, every known database is checked again
+    del feeds[:]
+    updated = []
+    mux = trombi.ChangesMultiplexer(s, None)
+    mux.start()
+    mux.seqs['testdb2'] = 1
+    params = reconnect(mux, {'db_name': 'testdb', 'type': 'updated'})
+    assert 'since' not in params
+    eq(updated, ['testdb', 'testdb2'])
+    mux.stop()
@@ -25,10 +25,12 @@ import os
 import sys
 import errno
 import shutil
+import time
 import types
 import nose.tools
 
 from datetime import datetime
+from tornado import gen
 from tornado.ioloop import IOLoop
 
 def unrandom(random=None):
@@ -63,6 +65,12 @@ def with_ioloop(func):
 
     return wrapper
 
+@gen.coroutine
+def wait_for(ioloop, condition, interval=0.05):
+    # Polls condition until it is true
+    while not condition():
+        yield gen.Task(ioloop.add_timeout, time.time() + interval)
+
 def mkdir(*a, **kw):
     try:
         os.mkdir(*a, **kw)
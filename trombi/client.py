@@ -23,12 +23,18 @@
 
 """Asynchronous CouchDB client"""
 
+import codecs
 import functools
 from hashlib import sha1
 import uuid
 import logging
+import os
 import re
 import collections
+import random
+import time
+import zlib
+import tornado
 import tornado.ioloop
 import urllib
 
@@ -36,15 +42,23 @@ try:
     # Python 3
     from urllib.parse import quote as urlquote
     from urllib.parse import urlencode
+    from urllib.parse import urlsplit
 except ImportError:
     # Python 2
     from urllib import quote as urlquote
     from urllib import urlencode
+    from urlparse import urlsplit
 
 from base64 import b64encode, b64decode
-from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPResponse
 from tornado.httputil import HTTPHeaders
 
+try:
+    from tornado.concurrent import Future
+except ImportError:
+    # Tornado before 3.0
+    Future = None
+
 log = logging.getLogger('trombi')
 
 try:
@@ -52,6 +66,21 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import trombi.errors
 
 
@@ -63,19 +92,32 @@ def from_uri(uri, fetch_args=None, io_loop=None, **kwargs):
         # Python 2
         from urlparse import urlparse, urlunsplit
 
-    p = urlparse(uri)
-    if p.params or p.query or p.fragment:
-        raise ValueError(
-            'Invalid database address: %s (extra query params)' % uri)
-    if not p.scheme in ('http', 'https'):
+    if isinstance(uri, (list, tuple)):
+        uris = uri
+    else:
+        uris = [uri]
+
+    baseurls = []
+    db_names = set()
+    for uri in uris:
+        p = urlparse(uri)
+        if p.params or p.query or p.fragment:
+            raise ValueError(
+                'Invalid database address: %s (extra query params)' % uri)
+        if not p.scheme in ('http', 'https'):
+            raise ValueError(
+                'Invalid database address: %s (only http:// and https:// are supported)' % uri)
+
+        baseurls.append(urlunsplit((p.scheme, p.netloc, '', '', '')))
+        db_names.add(p.path.lstrip('/').rstrip('/'))
+
+    if len(db_names) != 1:
         raise ValueError(
-            'Invalid database address: %s (only http:// and https:// are supported)' % uri)
-
-    baseurl = urlunsplit((p.scheme, p.netloc, '', '', ''))
-    server = Server(baseurl, fetch_args, io_loop=io_loop, **kwargs)
+            'Invalid database addresses: %s (database names differ)' %
+            ', '.join(uris))
 
-    db_name = p.path.lstrip('/').rstrip('/')
-    return Database(server, db_name)
+    server = Server(baseurls, fetch_args, io_loop=io_loop, **kwargs)
+    return Database(server, db_names.pop())
 
 
 class TrombiError(object):
@@ -95,12 +137,39 @@ class TrombiErrorResponse(TrombiError):
         return 'CouchDB reported an error: %s (%d)' % (self.msg, self.errno)
 
 
+def _future_callback(callback):
+    """
+    Returns *callback* and None if *callback* is given. Otherwise
+    returns a callback resolving a new Future and the Future. Error
+    responses are set as exceptions of the Future.
+    """
+    if callback is not None:
+        return callback, None
+    if Future is None:
+        raise TypeError('callback is required with Tornado before 3.0')
+
+    future = Future()
+
+    def _resolve(result):
+        if future.done():
+            # Cancelled by the caller
+            return
+        if isinstance(result, TrombiErrorResponse):
+            future.set_exception(
+                trombi.errors.exception_for(result.errno, result.msg))
+        else:
+            future.set_result(result)
+
+    return _resolve, future
+
+
 class TrombiObject(object):
     """
     Dummy result for queries that really don't have anything sane to
     return, like succesful database deletion.
 
     """
+    __slots__ = ()
     error = False
 
 
@@ -120,21 +189,122 @@ class TrombiDict(TrombiObject, dict):
         return dict(self)
 
 
+# Document ids are passed to CouchDB as they are, not as JSON
+_RAW_PARAMS = frozenset(['startkey_docid', 'endkey_docid'])
+
+
 def _jsonize_params(params):
     result = dict()
     for key, value in params.items():
-        result[key] = json.dumps(value)
-    return urlencode(result)
+        if key in _RAW_PARAMS:
+            result[key] = value
+        else:
+            result[key] = json.dumps(value)
+    # Sorted so that equal queries have equal urls
+    return urlencode(sorted(result.items()))
+
+
+class _LocalError(Exception):
+    """
+    Error raised by trombi itself instead of the HTTP client or
+    CouchDB, passed in the error attribute of a faked response.
+    """
+    def __init__(self, errno, msg):
+        super(_LocalError, self).__init__(msg)
+        self.errno = errno
+        self.msg = msg
+
+
+def _local_error_response(url, errno, msg):
+    return HTTPResponse(HTTPRequest(url), 599, error=_LocalError(errno, msg))
+
+
+try:
+    json.loads(b'{}')
+    _JSON_LOADS_BYTES = True
+except TypeError:
+    # Python 3 before 3.6
+    _JSON_LOADS_BYTES = False
+
+
+class JSONCodec(object):
+    """
+    Encodes and decodes JSON using the json module of the standard
+    library (or simplejson). *encoder* is an optional
+    :class:`json.JSONEncoder` subclass used for encoding.
+    """
+    def __init__(self, encoder=None):
+        self.encoder = encoder
+
+    def dumps(self, obj):
+        return json.dumps(obj, cls=self.encoder)
+
+    def loads(self, data):
+        if not _JSON_LOADS_BYTES and isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    Encodes and decodes JSON using orjson, which parses bytes
+    directly and produces bytes. Objects orjson can't serialize are
+    encoded with the standard library.
+    """
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return super(OrjsonCodec, self).dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    """
+    Encodes and decodes JSON using ujson. Objects ujson can't
+    serialize are encoded with the standard library.
+    """
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(obj)
+        except (TypeError, OverflowError):
+            return super(UjsonCodec, self).dumps(obj)
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+def default_codec(json_encoder=None):
+    """
+    Returns the fastest available JSON codec. A custom *json_encoder*
+    is only supported by the standard library.
+    """
+    if json_encoder is not None:
+        return JSONCodec(json_encoder)
+    if orjson is not None:
+        return OrjsonCodec()
+    if ujson is not None:
+        return UjsonCodec()
+    return JSONCodec()
 
 
-def _error_response(response):
+def _error_response(response, body=None):
+    if isinstance(response.error, _LocalError):
+        return TrombiErrorResponse(response.error.errno, response.error.msg)
+
     if response.code == 599:
         return TrombiErrorResponse(599, 'Unable to connect to CouchDB')
 
+    # Streamed responses hand their body to the streaming callback,
+    # so the caller passes in whatever it collected.
+    if body is None:
+        body = response.body
     try:
-        content = json.loads(response.body.decode('utf-8'))
+        content = json.loads(body.decode('utf-8'))
     except ValueError:
-        return TrombiErrorResponse(response.code, response.body)
+        return TrombiErrorResponse(response.code, body)
     try:
         return TrombiErrorResponse(response.code, content['reason'])
     except (KeyError, TypeError):
@@ -142,14 +312,395 @@ def _error_response(response):
         return TrombiErrorResponse(response.code, content)
 
 
+def _view_url(design_doc, viewname, params):
+    if not design_doc and viewname == '_all_docs':
+        url = '_all_docs'
+    else:
+        url = '_design/%s/_view/%s' % (design_doc, viewname)
+
+    # We need to pop keys before constructing the url to avoid it
+    # ending up twice in the request, both in the body and as a
+    # query parameter.
+    keys = params.pop('keys', None)
+
+    if params:
+        url = '%s?%s' % (url, _jsonize_params(params))
+    return url, keys
+
+
+def _unchanged(data, doc_id=None):
+    # Saving a clean document again would only create a new revision
+    return (isinstance(data, Document) and not data.dirty and
+            data.rev is not None and doc_id in (None, data.id))
+
+
+def _set_args(name, args, callback):
+    """
+    Parses the ``[doc_id, ]data[, callback]`` arguments of the set
+    methods. Returns a tuple of doc_id, data and callback.
+    """
+    if callback:
+        args += (callback,)
+    if len(args) == 1 or (len(args) == 2 and callable(args[1])):
+        data = args[0]
+        callback = args[1] if len(args) == 2 else None
+        doc_id = None
+    elif len(args) in (2, 3):
+        doc_id, data = args[:2]
+        callback = args[2] if len(args) == 3 else None
+    else:
+        raise TypeError(
+            '%s takes at most 2 non-keyword arguments.' % name)
+    return doc_id, data, callback
+
+
+def _gzip(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    # 16 + MAX_WBITS produces a gzip header and trailer instead of zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+if getattr(tornado, 'version_info', (0,)) >= (4, 0):
+    _DECOMPRESS_ARG = 'decompress_response'
+else:
+    _DECOMPRESS_ARG = 'use_gzip'
+
+
+def _create_client(io_loop, keep_alive, **client_args):
+    if not keep_alive:
+        return AsyncHTTPClient(io_loop, **client_args)
+
+    # Tornado shares one client per IOLoop and ignores max_clients
+    # when it already exists, so the pooled client gets its own
+    client_args['force_instance'] = True
+    # Tornado's simple HTTP client opens a new connection for every
+    # request, the curl based client keeps the connections alive and
+    # reuses them. Use it if pycurl is available.
+    try:
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+    except ImportError:
+        return AsyncHTTPClient(io_loop, **client_args)
+    return CurlAsyncHTTPClient(io_loop, **client_args)
+
+
+class _HostSlots(object):
+    def __init__(self):
+        self.in_use = 0
+        self.waiting = collections.deque()
+
+
+class ConnectionPool(object):
+    """
+    Bounds the number of simultaneous connections per CouchDB host.
+
+    Requests exceeding the limit wait in a FIFO queue until a
+    connection is released. Keeping the connections alive is left to
+    the HTTP client.
+    """
+    def __init__(self, io_loop, max_host_connections=10):
+        self.io_loop = io_loop
+        self.max_host_connections = max_host_connections
+        self._hosts = {}
+
+    def acquire(self, host, callback):
+        """
+        Calls *callback* once a connection to *host* is available.
+        """
+        try:
+            slots = self._hosts[host]
+        except KeyError:
+            slots = self._hosts[host] = _HostSlots()
+        if slots.in_use < self.max_host_connections:
+            slots.in_use += 1
+            callback()
+        else:
+            slots.waiting.append(callback)
+
+    def release(self, host):
+        """
+        Releases a connection to *host* acquired with :meth:`acquire`.
+        """
+        slots = self._hosts[host]
+        if slots.waiting:
+            # Hand the connection straight to the next waiting
+            # request. It is started from the IOLoop, as we might be
+            # in the middle of the previous request's callback.
+            self.io_loop.add_callback(slots.waiting.popleft())
+            return
+
+        slots.in_use -= 1
+        if not slots.in_use:
+            del self._hosts[host]
+
+    def stats(self, host=None):
+        """
+        Returns a dict with the number of connections in use and
+        requests waiting for a connection. If *host* is not given, the
+        numbers are summed over all hosts.
+        """
+        if host is not None:
+            hosts = [self._hosts[host]] if host in self._hosts else []
+        else:
+            hosts = self._hosts.values()
+        result = {'in_use': 0, 'waiting': 0}
+        for slots in hosts:
+            result['in_use'] += slots.in_use
+            result['waiting'] += len(slots.waiting)
+        return result
+
+
+class RetryPolicy(object):
+    """
+    Describes which failed requests are retried and how long to wait
+    before each retry.
+
+    The delay before the retry *n* is *backoff_base* * 2 ** (*n* - 1)
+    seconds, at most *backoff_max* seconds. With *jitter* the delay is
+    chosen randomly between zero and that value so that clients
+    failing at the same time do not retry at the same time.
+    """
+    def __init__(self, max_attempts=3, backoff_base=0.1, backoff_max=10,
+                 jitter=True, retry_codes=(599, 503),
+                 methods=('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.retry_codes = frozenset(retry_codes)
+        self.methods = frozenset(methods)
+
+    def should_retry(self, method, code, attempt):
+        return (attempt < self.max_attempts and
+                code in self.retry_codes and
+                method in self.methods)
+
+    def delay(self, attempt):
+        delay = min(self.backoff_max,
+                    self.backoff_base * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Keeps track of the failures of a node and stops sending requests
+    to it when it seems to be down.
+
+    The circuit opens after *failure_threshold* consecutive failures,
+    or when at least *error_rate* of the last *window* requests have
+    failed. After *reset_timeout* seconds a single probe request is
+    let through (half-open state). If it succeeds, the circuit closes,
+    otherwise it opens again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, error_rate=0.5, window=20,
+                 reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._outcomes = collections.deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._opened_at = 0
+        self._probing = False
+
+    @property
+    def available(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.time() >= self._opened_at + self.reset_timeout
+        return not self._probing
+
+    def allow(self):
+        """
+        Returns *True* if a request may be sent. In the half-open state
+        only one request at a time is allowed.
+        """
+        if not self.available:
+            return False
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self._probing = True
+        return True
+
+    def record(self, success):
+        if self.state == self.OPEN:
+            # A straggler sent before the circuit opened
+            return
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            if success:
+                self._close()
+            else:
+                self._open()
+            return
+
+        self._outcomes.append(success)
+        if success:
+            self._consecutive_failures = 0
+            return
+
+        self._consecutive_failures += 1
+        failures = len(self._outcomes) - sum(self._outcomes)
+        window_full = len(self._outcomes) == self._outcomes.maxlen
+        if (self._consecutive_failures >= self.failure_threshold or
+            (window_full and
+             failures >= self.error_rate * len(self._outcomes))):
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.time()
+
+    def _close(self):
+        self.state = self.CLOSED
+        self._outcomes.clear()
+        self._consecutive_failures = 0
+
+
+# Smoothing factor of the node latency averages
+_LATENCY_WEIGHT = 0.3
+
+# Response codes telling that the node itself is in trouble
+_NODE_FAILURE_CODES = frozenset([599, 502, 503, 504])
+
+
+class Node(object):
+    """
+    A single CouchDB node of a :class:`Server`.
+    """
+    def __init__(self, url, breaker=None):
+        self.url = url
+        self.breaker = breaker
+        # Exponentially weighted moving average of the response time
+        # in seconds, None until the first response
+        self.latency = None
+        self.down_until = 0
+
+    @property
+    def healthy(self):
+        return self.down_until <= time.time()
+
+    @property
+    def available(self):
+        return self.healthy and (
+            self.breaker is None or self.breaker.available)
+
+    def _update(self, response, cooldown):
+        if self.breaker is not None:
+            state = self.breaker.state
+            self.breaker.record(response.code not in _NODE_FAILURE_CODES)
+            if (self.breaker.state == CircuitBreaker.OPEN and
+                state != CircuitBreaker.OPEN):
+                log.warning('Circuit opened for %s', self.url)
+
+        if response.code in (599, 503):
+            self.down_until = time.time() + cooldown
+            return
+
+        self.down_until = 0
+        request_time = getattr(response, 'request_time', None)
+        if request_time is None:
+            return
+        if self.latency is None:
+            self.latency = request_time
+        else:
+            self.latency += _LATENCY_WEIGHT * (request_time - self.latency)
+
+
+# Request priorities, the lower the number, the sooner the request is
+# sent when the server has requests waiting
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_BULK = 2
+
+
+class RequestScheduler(object):
+    """
+    Limits the number of requests in flight to *max_in_flight*.
+
+    Requests exceeding the limit are queued by priority, and the
+    queued request with the highest priority is started when a
+    request finishes. *queue_limits* is a dict mapping priorities to
+    the maximum length of their queue. A request arriving to a full
+    queue is rejected.
+    """
+    def __init__(self, io_loop, max_in_flight, queue_limits=None):
+        self.io_loop = io_loop
+        self.max_in_flight = max_in_flight
+        self.queue_limits = queue_limits or {}
+        self.in_flight = 0
+        self._queues = {}
+
+    def submit(self, priority, start, reject):
+        """
+        Calls *start* when the request may be sent or *reject* if the
+        queue of *priority* is full. After calling *start*, the caller
+        must call :meth:`release` when the request has finished.
+        """
+        if self.in_flight < self.max_in_flight:
+            self.in_flight += 1
+            start()
+            return
+
+        queue = self._queues.setdefault(priority, collections.deque())
+        limit = self.queue_limits.get(priority)
+        if limit is not None and len(queue) >= limit:
+            reject()
+            return
+        queue.append(start)
+
+    def release(self):
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            if queue:
+                # Pass our slot to the waiting request
+                self.io_loop.add_callback(queue.popleft())
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        """
+        Returns the number of requests in flight and the number of
+        queued requests by priority.
+        """
+        queued = dict((priority, len(queue))
+                      for priority, queue in self._queues.items())
+        return {'in_flight': self.in_flight, 'queued': queued}
+
+
 class Server(TrombiObject):
     def __init__(self, baseurl, fetch_args=None, io_loop=None,
-                 json_encoder=None, **client_args):
+                 json_encoder=None, max_host_connections=None,
+                 probe_interval=30, cooldown=30,
+                 retry_policy=None, circuit_breaker=None,
+                 max_in_flight=None, queue_limits=None, compression=False,
+                 compress_threshold=1024, json_codec=None, **client_args):
         self.error = False
         self.session_cookie = None
-        self.baseurl = baseurl
-        if self.baseurl[-1] == '/':
-            self.baseurl = self.baseurl[:-1]
+        if isinstance(baseurl, (list, tuple)):
+            baseurls = baseurl
+        else:
+            baseurls = [baseurl]
+        if circuit_breaker is True:
+            circuit_breaker = {}
+        self.nodes = []
+        for url in baseurls:
+            if circuit_breaker is not None:
+                breaker = CircuitBreaker(**circuit_breaker)
+            else:
+                breaker = None
+            self.nodes.append(Node(url.rstrip('/'), breaker))
+        # All the urls are constructed using the first node, _fetch
+        # takes care of routing them to the chosen node.
+        self.baseurl = self.nodes[0].url
         if fetch_args is None:
             self._fetch_args = dict()
         else:
@@ -162,7 +713,73 @@ class Server(TrombiObject):
         # We can assign None to _json_encoder as the json (or
         # simplejson) then defaults to json.JSONEncoder
         self._json_encoder = json_encoder
-        self._client = AsyncHTTPClient(self.io_loop, **client_args)
+        if json_codec is None:
+            json_codec = default_codec(json_encoder)
+        self.codec = json_codec
+
+        if max_host_connections is not None:
+            self.pool = ConnectionPool(self.io_loop, max_host_connections)
+            # Let the pool do the queueing instead of the HTTP client
+            client_args.setdefault(
+                'max_clients', max_host_connections * len(self.nodes))
+        else:
+            self.pool = None
+        self._client = _create_client(
+            self.io_loop, self.pool is not None, **client_args)
+
+        if max_in_flight is not None:
+            self.scheduler = RequestScheduler(
+                self.io_loop, max_in_flight, queue_limits)
+        else:
+            self.scheduler = None
+
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.retry_policy = retry_policy
+        self.probe_interval = probe_interval
+        self.cooldown = cooldown
+        self._probe_timeout = None
+        if len(self.nodes) > 1:
+            self._schedule_probe()
+
+    def close(self):
+        """
+        Stops the periodic health probes of the nodes.
+        """
+        if self._probe_timeout is not None:
+            self.io_loop.remove_timeout(self._probe_timeout)
+            self._probe_timeout = None
+
+    def _schedule_probe(self):
+        self._probe_timeout = self.io_loop.add_timeout(
+            time.time() + self.probe_interval, self._probe)
+
+    def _probe(self):
+        for node in self.nodes:
+            self._client.fetch(
+                '%s/' % node.url,
+                functools.partial(node._update, cooldown=self.cooldown),
+                **self._fetch_args)
+        self._schedule_probe()
+
+    def _choose_node(self, method):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+
+        healthy = [node for node in self.nodes if node.available]
+        if not healthy:
+            # Everything is down, try the node that has been resting
+            # for the longest time
+            return min(self.nodes, key=lambda node: node.down_until)
+
+        if method in ('GET', 'HEAD'):
+            # Reads go to the fastest node. Nodes without latency
+            # information get a chance to measure it first.
+            return min(healthy, key=lambda node: node.latency or 0)
+
+        # Writes go to the first healthy node to avoid needless
+        # conflicts between the nodes
+        return healthy[0]
 
     def _invalid_db_name(self, name):
         return TrombiErrorResponse(
@@ -170,7 +787,7 @@ class Server(TrombiObject):
             'Invalid database name: %r' % name,
             )
 
-    def _fetch(self, *args, **kwargs):
+    def _fetch(self, url, callback, **kwargs):
         # This is just a convenince wrapper for _client.fetch
 
         # Set default arguments for a fetch
@@ -178,6 +795,8 @@ class Server(TrombiObject):
             'headers': HTTPHeaders({'Content-Type': 'application/json'})
         }
         fetch_args.update(self._fetch_args)
+        retry_policy = kwargs.pop('retry_policy', self.retry_policy)
+        priority = kwargs.pop('priority', PRIORITY_INTERACTIVE)
         fetch_args.update(kwargs)
 
         if self.session_cookie:
@@ -187,12 +806,100 @@ class Server(TrombiObject):
             else:
                 fetch_args['Cookie'] = self.sesison_cookie
 
-        self._client.fetch(*args, **fetch_args)
+        method = fetch_args.get('method', 'GET')
+        streaming = 'streaming_callback' in fetch_args
+
+        if self.compression:
+            # Tornado asks for a gzipped response and decompresses it
+            fetch_args[_DECOMPRESS_ARG] = True
+            body = fetch_args.get('body')
+            if body and len(body) >= self.compress_threshold:
+                fetch_args['body'] = _gzip(body)
+                fetch_args['headers'] = HTTPHeaders(fetch_args['headers'])
+                fetch_args['headers']['Content-Encoding'] = 'gzip'
+        if streaming:
+            # The streamed data has already been handed out, it
+            # can't be requested again
+            retry_policy = None
+
+        # Streaming requests, like continuous changes feeds, may last
+        # forever and are not counted in the in-flight limit
+        scheduled = self.scheduler is not None and not streaming
+
+        def _done(response):
+            if scheduled:
+                self.scheduler.release()
+            callback(response)
+
+        def _attempt(attempt):
+            node = self._choose_node(method)
+            node_url = url
+            if node_url.startswith(self.baseurl):
+                node_url = node.url + node_url[len(self.baseurl):]
+
+            if node.breaker is not None and not node.breaker.allow():
+                response = _local_error_response(
+                    node_url,
+                    trombi.errors.CIRCUIT_OPEN,
+                    'Circuit open for %s' % node.url)
+                self.io_loop.add_callback(functools.partial(_done, response))
+                return
 
-    def create(self, name, callback):
+            def _really_callback(response):
+                # Streamed requests end with a 599 when we close them,
+                # and their duration says nothing about the latency
+                if not streaming:
+                    node._update(response, self.cooldown)
+                if (retry_policy is not None and
+                    retry_policy.should_retry(method, response.code, attempt)):
+                    log.debug('Retrying %s %s after response code %d',
+                              method, url, response.code)
+                    self.io_loop.add_timeout(
+                        time.time() + retry_policy.delay(attempt),
+                        functools.partial(_attempt, attempt + 1))
+                    return
+                _done(response)
+
+            # Tornado modifies the headers of the request, so each
+            # attempt needs a copy of its own
+            attempt_args = dict(fetch_args)
+            attempt_args['headers'] = HTTPHeaders(fetch_args['headers'])
+            self._send(node_url, _really_callback, attempt_args)
+
+        if not scheduled:
+            _attempt(1)
+            return
+
+        def _reject():
+            response = _local_error_response(
+                url,
+                trombi.errors.QUEUE_FULL,
+                'Request queue full for priority %d' % priority)
+            self.io_loop.add_callback(functools.partial(callback, response))
+
+        self.scheduler.submit(priority, functools.partial(_attempt, 1), _reject)
+
+    def _send(self, url, callback, fetch_args):
+        if self.pool is None:
+            self._client.fetch(url, callback, **fetch_args)
+            return
+
+        host = urlsplit(url).netloc
+
+        def _release(response):
+            self.pool.release(host)
+            callback(response)
+
+        self.pool.acquire(
+            host,
+            functools.partial(self._client.fetch, url, _release, **fetch_args))
+
+    def create(self, name, callback=None):
+        callback, future = _future_callback(callback)
         if not VALID_DB_NAME.match(name):
             # Avoid additional HTTP Query by doing the check here
             callback(self._invalid_db_name(name))
+            return future
 
         def _create_callback(response):
             if response.code == 201:
@@ -212,10 +919,13 @@ class Server(TrombiObject):
             method='PUT',
             body='',
             )
+        return future
 
-    def get(self, name, callback, create=False):
+    def get(self, name, callback=None, create=False):
+        callback, future = _future_callback(callback)
         if not VALID_DB_NAME.match(name):
             callback(self._invalid_db_name(name))
+            return future
 
         def _really_callback(response):
             if response.code == 200:
@@ -236,8 +946,11 @@ class Server(TrombiObject):
             '%s/%s' % (self.baseurl, name),
             _really_callback,
             )
+        return future
+
+    def delete(self, name, callback=None):
+        callback, future = _future_callback(callback)
 
-    def delete(self, name, callback):
         def _really_callback(response):
             if response.code == 200:
                 callback(TrombiObject())
@@ -255,12 +968,15 @@ class Server(TrombiObject):
             _really_callback,
             method='DELETE',
             )
+        return future
+
+    def list(self, callback=None):
+        callback, future = _future_callback(callback)
 
-    def list(self, callback):
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
-                callback(Database(self, x) for x in json.loads(body))
+                body = self.codec.loads(response.body)
+                callback(Database(self, x) for x in body)
             else:
                 callback(_error_response(response))
 
@@ -268,8 +984,33 @@ class Server(TrombiObject):
             '%s/%s' % (self.baseurl, '_all_dbs'),
             _really_callback,
             )
+        return future
 
-    def add_user(self, name, password, callback, doc=None):
+    def db_updates(self, callback=None, feed='longpoll', **kw):
+        if callback is None and feed == 'continuous':
+            raise TypeError('Continuous updates feed requires a callback')
+        callback, future = _future_callback(callback)
+
+        kw['feed'] = feed
+        url = '%s/_db_updates?%s' % (self.baseurl, urlencode(kw))
+        if feed == 'continuous':
+            updates_feed = ChangesFeed(self, callback)
+            self._fetch(url, updates_feed._done,
+                        streaming_callback=updates_feed._stream,
+                        request_timeout=0)
+            return updates_feed
+
+        def _really_callback(response):
+            if response.code != 200:
+                callback(_error_response(response))
+                return
+            callback(TrombiDict(self.codec.loads(response.body)))
+
+        self._fetch(url, _really_callback)
+        return future
+
+    def add_user(self, name, password, callback=None, doc=None):
+        callback, future = _future_callback(callback)
         userdb = Database(self, '_users')
 
         if not doc:
@@ -287,8 +1028,10 @@ class Server(TrombiObject):
             doc['_id'] = 'org.couchdb.user:%s' % name
 
         userdb.set(doc, callback)
+        return future
 
-    def get_user(self, name, callback, attachments=False):
+    def get_user(self, name, callback=None, attachments=False):
+        callback, future = _future_callback(callback)
         userdb = Database(self, '_users')
 
         doc_id = name
@@ -296,40 +1039,54 @@ class Server(TrombiObject):
             doc_id = 'org.couchdb.user:%s' % name
 
         userdb.get(doc_id, callback, attachments=attachments)
+        return future
 
-    def update_user(self, user_doc, callback):
+    def update_user(self, user_doc, callback=None):
+        callback, future = _future_callback(callback)
         userdb = Database(self, '_users')
         userdb.set(user_doc, callback)
+        return future
+
+    def update_user_password(self, username, password, callback=None):
+        callback, future = _future_callback(callback)
 
-    def update_user_password(self, username, password, callback):
         def _really_callback(user_doc):
             if user_doc.error:
                 callback(user_doc)
+                return
             user_doc['password_sha'] = sha1(password + user_doc['salt']).hexdigest()
             self.update_user(user_doc, callback)
 
         self.get_user(username, _really_callback)
+        return future
 
-    def delete_user(self, user_doc, callback):
+    def delete_user(self, user_doc, callback=None):
+        callback, future = _future_callback(callback)
         userdb = Database(self, '_users')
         userdb.delete(user_doc, callback)
+        return future
+
+    def logout(self, callback=None):
+        callback, future = _future_callback(callback)
 
-    def logout(self, callback):
         def _really_callback(response):
             if response.code == 200:
                 self.session_cookie = None
-                callback(TrombiResult(json.loads(response.body)))
+                callback(TrombiResult(self.codec.loads(response.body)))
             else:
                 callback(_error_response(response))
 
         url = '%s/%s' % (self.baseurl, '_session')
         self._client.fetch(url, _really_callback, method='DELETE')
+        return future
+
+    def login(self, username, password, callback=None):
+        callback, future = _future_callback(callback)
 
-    def login(self, username, password, callback):
         def _really_callback(response):
             if response.code in (200, 302):
                 self.session_cookie = response.headers['Set-Cookie']
-                response_body = json.loads(response.body)
+                response_body = self.codec.loads(response.body)
                 callback(TrombiResult(response_body))
             else:
                 callback(_error_response(response))
@@ -338,56 +1095,73 @@ class Server(TrombiObject):
         url = '%s/%s' % (self.baseurl, '_session')
 
         self._client.fetch(url, _really_callback, method='POST', body=body)
+        return future
+
+    def session(self, callback=None):
+        callback, future = _future_callback(callback)
 
-    def session(self, callback):
         def _really_callback(response):
             if response.code == 200:
-                body = json.loads(response.body)
+                body = self.codec.loads(response.body)
                 callback(TrombiResult(body))
             else:
                 callback(_error_response(response))
 
         url = '%s/%s' % (self.baseurl, '_session')
         self._client.fetch(url, _really_callback)
+        return future
 
 
 class Database(TrombiObject):
     def __init__(self, server, name):
         self.server = server
         self._json_encoder = self.server._json_encoder
+        self.codec = self.server.codec
         self.name = name
         self.baseurl = '%s/%s' % (self.server.baseurl, self.name)
+        self.priority = PRIORITY_INTERACTIVE
+        # Overrides the RetryPolicy of the server if not None
+        self.retry_policy = None
+        # Optional DocumentLoader batching the get calls
+        self.loader = None
+        # Optional BulkWriter batching the set calls
+        self.writer = None
+        # Optional DocumentCache for the get calls
+        self.cache = None
+        # Optional ViewCache for the view calls
+        self.view_cache = None
 
     def _fetch(self, url, *args, **kwargs):
         # Just a convenience wrapper
+        kwargs.setdefault('priority', self.priority)
+        if self.retry_policy is not None:
+            kwargs.setdefault('retry_policy', self.retry_policy)
         if 'baseurl' in kwargs:
             url = '%s/%s' % (kwargs.pop('baseurl'), url)
         else:
             url = '%s/%s' % (self.baseurl, url)
         return self.server._fetch(url, *args, **kwargs)
 
-    def info(self, callback):
+    def _invalidate(self, doc_id):
+        if self.cache is not None:
+            self.cache.invalidate(doc_id)
+
+    def info(self, callback=None):
+        callback, future = _future_callback(callback)
+
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
-                callback(TrombiDict(json.loads(body)))
+                callback(TrombiDict(self.codec.loads(response.body)))
             else:
                 callback(_error_response(response))
 
         self._fetch('', _really_callback)
+        return future
 
     def set(self, *args, **kwargs):
-        cb = kwargs.pop('callback', None)
-        if cb:
-            args += (cb,)
-        if len(args) == 2:
-            data, callback = args
-            doc_id = None
-        elif len(args) == 3:
-            doc_id, data, callback = args
-        else:
-            raise TypeError(
-                'Database.set takes at most 2 non-keyword arguments.')
+        doc_id, data, callback = _set_args(
+            'Database.set', args, kwargs.pop('callback', None))
+        changed_only = kwargs.pop('changed_only', False)
 
         if kwargs:
             if list(kwargs.keys()) != ['attachments']:
@@ -404,6 +1178,19 @@ class Database(TrombiObject):
         else:
             attachments = {}
 
+        if changed_only and not attachments and _unchanged(data, doc_id):
+            callback, future = _future_callback(callback)
+            self.server.io_loop.add_callback(
+                functools.partial(callback, data))
+            return future
+
+        if self.writer is not None and not attachments:
+            if doc_id is None:
+                return self.writer.set(data, callback=callback)
+            return self.writer.set(doc_id, data, callback=callback)
+
+        callback, future = _future_callback(callback)
+
         if isinstance(data, Document):
             doc = data
         else:
@@ -436,13 +1223,15 @@ class Database(TrombiObject):
                 # don't set the content as the response.code will not
                 # be 201 at that point either
                 if response.body is not None:
-                    content = json.loads(response.body.decode('utf-8'))
+                    content = self.codec.loads(response.body)
             except ValueError:
                 content = response.body
 
             if response.code == 201:
                 doc.id = content['id']
                 doc.rev = content['rev']
+                doc.dirty = False
+                self._invalidate(doc.id)
                 callback(doc)
             else:
                 callback(_error_response(response))
@@ -451,14 +1240,22 @@ class Database(TrombiObject):
             url,
             _really_callback,
             method=method,
-            body=json.dumps(doc.raw(), cls=self._json_encoder),
+            body=self.codec.dumps(doc._raw()),
         )
+        return future
+
+    def get(self, doc_id, callback=None, attachments=False):
+        if self.cache is not None and not attachments:
+            return self._cached_get(doc_id, callback)
+        if self.loader is not None and not attachments:
+            return self.loader.get(doc_id, callback)
+
+        callback, future = _future_callback(callback)
 
-    def get(self, doc_id, callback, attachments=False):
         def _really_callback(response):
             if response.code == 200:
-                data = json.loads(response.body.decode('utf-8'))
-                doc = Document(self, data)
+                data = self.codec.loads(response.body)
+                doc = Document._from_json(self, data)
                 callback(doc)
             elif response.code == 404:
                 # Document doesn't exist
@@ -482,8 +1279,11 @@ class Database(TrombiObject):
             _really_callback,
             **kwargs
             )
+        return future
+
+    def get_attachment(self, doc_id, attachment_name, callback=None):
+        callback, future = _future_callback(callback)
 
-    def get_attachment(self, doc_id, attachment_name, callback):
         def _really_callback(response):
             if response.code == 200:
                 callback(response.body)
@@ -500,39 +1300,159 @@ class Database(TrombiObject):
             '%s/%s' % (doc_id, attachment_name),
             _really_callback,
             )
+        return future
+
+    def view(self, design_doc, viewname, callback=None, **kwargs):
+        callback, future = _future_callback(callback)
 
-    def view(self, design_doc, viewname, callback, **kwargs):
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
                 callback(
-                    ViewResult(json.loads(body), db=self)
+                    ViewResult(self.codec.loads(response.body), db=self)
                     )
             else:
                 callback(_error_response(response))
 
-        if not design_doc and viewname == '_all_docs':
-            url = '_all_docs'
-        else:
-            url = '_design/%s/_view/%s' % (design_doc, viewname)
+        url, keys = _view_url(design_doc, viewname, kwargs)
 
-        # We need to pop keys before constructing the url to avoid it
-        # ending up twice in the request, both in the body and as a
-        # query parameter.
-        keys = kwargs.pop('keys', None)
+        if self.view_cache is not None:
+            body = None
+            if keys is not None:
+                body = self.codec.dumps({'keys': keys})
+            self._cached_view(url, body, callback)
+        elif keys is not None:
+            self._fetch(url, _really_callback,
+                        method='POST',
+                        body=self.codec.dumps({'keys': keys})
+                        )
+        else:
+            self._fetch(url, _really_callback)
+        return future
+
+    def _cached_view(self, url, body, callback):
+        cache = self.view_cache
+        key = (url, body)
+        entry = cache.lookup(key)
+        now = time.time()
+
+        def _result(body):
+            return ViewResult(self.codec.loads(body), db=self)
+
+        def _revalidate(callback):
+            generation = cache.generation
+
+            def _really_callback(response):
+                if response.code == 304 and entry is not None:
+                    cache.hits += 1
+                    entry.expires = time.time() + cache.ttl
+                    callback(entry.body)
+                elif response.code == 200:
+                    cache.misses += 1
+                    if cache.generation == generation:
+                        cache.store(key, response.headers.get('Etag'),
+                                    response.body)
+                    callback(response.body)
+                else:
+                    callback(_error_response(response))
+
+            # Replaces the default headers of _fetch, so keep the
+            # Content-Type of the keys POST
+            headers = HTTPHeaders({'Content-Type': 'application/json'})
+            if entry is not None and entry.etag:
+                headers['If-None-Match'] = entry.etag
+            kwargs = {'headers': headers}
+            if body is not None:
+                kwargs['method'] = 'POST'
+                kwargs['body'] = body
+            self._fetch(url, _really_callback, **kwargs)
+
+        def _deliver(body):
+            if isinstance(body, TrombiErrorResponse):
+                callback(body)
+            else:
+                callback(_result(body))
+
+        if entry is not None and now < entry.expires:
+            cache.hits += 1
+            self.server.io_loop.add_callback(
+                functools.partial(callback, _result(entry.body)))
+        elif (entry is not None and
+              now < entry.expires + cache.stale_while_revalidate):
+            # Counted as a hit or miss when the refresh completes
+            self.server.io_loop.add_callback(
+                functools.partial(callback, _result(entry.body)))
+            if not entry.refreshing:
+                entry.refreshing = True
+
+                def _refreshed(body):
+                    entry.refreshing = False
+                    if isinstance(body, TrombiErrorResponse):
+                        log.warning('Refreshing view %s failed: %s',
+                                    url, body.msg)
+
+                _revalidate(_refreshed)
+        else:
+            _revalidate(_deliver)
+
+    def stream_view(self, design_doc, viewname, callback, batch_size=100,
+                    **kwargs):
+        parser = _ViewStreamParser()
+        batch = []
+
+        def _deliver(rows):
+            result = dict(parser.header or {})
+            result['rows'] = rows
+            # Escape the streaming_callback context, see changes()
+            cb = functools.partial(callback, ViewResult(result, db=self))
+            self.server.io_loop.add_callback(cb)
+
+        def _add_rows(rows):
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    _deliver(batch[:])
+                    del batch[:]
+
+        def _stream(data):
+            _add_rows(parser.feed(data))
 
-        if kwargs:
-            url = '%s?%s' % (url, _jsonize_params(kwargs))
+        def _really_callback(response):
+            if response.code != 200:
+                error = _error_response(response, parser.pending())
+                self.server.io_loop.add_callback(
+                    functools.partial(callback, error))
+                return
 
+            try:
+                _add_rows(parser.close())
+            except ValueError:
+                # Don't let a partial view pass for a complete one
+                result = TrombiErrorResponse(
+                    trombi.errors.SERVER_ERROR,
+                    'View response ended before all rows')
+            else:
+                # Call callback with None to indicate the end of the view
+                result = None
+            if batch:
+                _deliver(batch[:])
+            self.server.io_loop.add_callback(
+                functools.partial(callback, result))
+
+        url, keys = _view_url(design_doc, viewname, kwargs)
         if keys is not None:
             self._fetch(url, _really_callback,
                         method='POST',
-                        body=json.dumps({'keys': keys})
-                        )
+                        body=self.codec.dumps({'keys': keys}),
+                        streaming_callback=_stream)
         else:
-            self._fetch(url, _really_callback)
+            self._fetch(url, _really_callback, streaming_callback=_stream)
+
+    def iterview(self, design_doc, viewname, batch_size=100, **params):
+        return ViewIterator(self, design_doc, viewname, batch_size, **params)
+
+    def list(self, design_doc, listname, viewname, callback=None, **kwargs):
+        callback, future = _future_callback(callback)
 
-    def list(self, design_doc, listname, viewname, callback, **kwargs):
         def _really_callback(response):
             if response.code == 200:
                 callback(TrombiResult(response.body))
@@ -544,14 +1464,16 @@ class Database(TrombiObject):
             url = '%s?%s' % (url, _jsonize_params(kwargs))
 
         self._fetch(url, _really_callback)
+        return future
 
     def temporary_view(self, callback, map_fun, reduce_fun=None,
                        language='javascript', **kwargs):
+        callback, future = _future_callback(callback)
+
         def _really_callback(response):
             if response.code == 200:
-                body = response.body.decode('utf-8')
                 callback(
-                    ViewResult(json.loads(body), db=self)
+                    ViewResult(self.codec.loads(response.body), db=self)
                     )
             else:
                 callback(_error_response(response))
@@ -565,17 +1487,64 @@ class Database(TrombiObject):
             body['reduce'] = reduce_fun
 
         self._fetch(url, _really_callback, method='POST',
-                    body=json.dumps(body),
+                    body=self.codec.dumps(body),
                     headers={'Content-Type': 'application/json'})
+        return future
+
+    def _cached_get(self, doc_id, callback):
+        callback, future = _future_callback(callback)
+        cache = self.cache
+        entry = cache.lookup(doc_id)
+
+        if entry is not None and cache.coherent:
+            # The changes feed tells us if the document changes, no
+            # need to ask CouchDB
+            cache.hits += 1
+            doc = Document._from_json(self, self.codec.loads(entry[1]))
+            self.server.io_loop.add_callback(functools.partial(callback, doc))
+            return future
+
+        generation = cache.generation
+
+        def _really_callback(response):
+            if response.code == 304 and entry is not None:
+                cache.hits += 1
+                body = entry[1]
+            elif response.code == 200:
+                cache.misses += 1
+                body = response.body
+                etag = response.headers.get('Etag')
+                if etag and cache.generation == generation:
+                    cache.store(doc_id, etag, body)
+            elif response.code == 404:
+                cache.invalidate(doc_id)
+                callback(None)
+                return
+            else:
+                callback(_error_response(response))
+                return
+            # A new Document every time, as the caller may modify it
+            callback(Document._from_json(self, self.codec.loads(body)))
+
+        headers = {}
+        if entry is not None:
+            headers['If-None-Match'] = entry[0]
+        self._fetch(urlquote(doc_id, safe=''), _really_callback,
+                    headers=headers)
+        return future
+
+    def delete(self, data, callback=None):
+        callback, future = _future_callback(callback)
 
-    def delete(self, data, callback):
         def _really_callback(response):
             try:
-                json.loads(response.body.decode('utf-8'))
-            except ValueError:
+                self.codec.loads(response.body)
+            except (TypeError, ValueError):
+                # TypeError is risen if there is no body at all
                 callback(_error_response(response))
                 return
             if response.code == 200:
+                self._invalidate(doc.id)
                 callback(self)
             else:
                 callback(_error_response(response))
@@ -591,23 +1560,60 @@ class Database(TrombiObject):
             _really_callback,
             method='DELETE',
             )
+        return future
+
+    def bulk_docs(self, data, callback=None, all_or_nothing=False,
+                  changed_only=False):
+        callback, future = _future_callback(callback)
+        data = list(data)
+        if changed_only:
+            # Indexes of the documents to send
+            send = [i for i, element in enumerate(data)
+                    if not _unchanged(element)]
+        else:
+            send = range(len(data))
+
+        def _result(content):
+            if len(send) < len(data):
+                # Report the skipped documents as saved
+                lines = [None] * len(data)
+                for i, line in zip(send, content):
+                    lines[i] = line
+                for i, element in enumerate(data):
+                    if lines[i] is None:
+                        lines[i] = {'id': element.id, 'rev': element.rev}
+                content = lines
+
+            for element, line in zip(data, content):
+                if 'id' in line:
+                    self._invalidate(line['id'])
+                if isinstance(element, Document) and 'rev' in line:
+                    element.id = line['id']
+                    element.rev = line['rev']
+                    element.dirty = False
+            return BulkResult(content)
 
-    def bulk_docs(self, data, callback, all_or_nothing=False):
         def _really_callback(response):
             if response.code == 200 or response.code == 201:
                 try:
-                    content = json.loads(response.body.decode('utf-8'))
+                    content = self.codec.loads(response.body)
                 except ValueError:
                     callback(TrombiErrorResponse(response.code, response.body))
                 else:
-                    callback(BulkResult(content))
+                    callback(_result(content))
             else:
                 callback(_error_response(response))
 
+        if data and not send:
+            self.server.io_loop.add_callback(
+                functools.partial(callback, _result([])))
+            return future
+
         docs = []
-        for element in data:
+        for i in send:
+            element = data[i]
             if isinstance(element, Document):
-                docs.append(element.raw())
+                docs.append(element._raw())
             else:
                 docs.append(element)
 
@@ -619,120 +1625,350 @@ class Database(TrombiObject):
             '_bulk_docs',
             _really_callback,
             method='POST',
-            body=json.dumps(payload),
+            body=self.codec.dumps(payload),
+            priority=max(self.priority, PRIORITY_BULK),
             )
+        return future
+
+    def changes(self, callback=None, timeout=None, feed='normal',
+                batch=False, batch_window=None, max_queue=None, **kw):
+        if callback is None and feed == 'continuous':
+            raise TypeError('Continuous changes feed requires a callback')
+        callback, future = _future_callback(callback)
+
+        couchdb_params = kw
+        couchdb_params['feed'] = feed
+        if timeout is not None:
+            # CouchDB takes timeouts in milliseconds
+            couchdb_params['timeout'] = timeout * 1000
+        url = '_changes?%s' % urlencode(couchdb_params)
+        log.debug('Fetching changes from %s', url)
+        if feed == 'continuous':
+            changes_feed = ChangesFeed(self.server, callback, batch,
+                                       batch_window, max_queue)
+            # The feed lasts until it's closed, so don't let Tornado
+            # end it after request_timeout
+            self._fetch(url, changes_feed._done,
+                        streaming_callback=changes_feed._stream,
+                        request_timeout=0)
+            return changes_feed
 
-    def changes(self, callback, timeout=None, feed='normal', **kw):
         def _really_callback(response):
             log.debug('Changes feed response: %s', response)
             if response.code != 200:
                 callback(_error_response(response))
                 return
-            if feed == 'continuous':
-                # Feed terminated, call callback with None to indicate
-                # this, if the mode is continous
-                callback(None)
-            else:
-                body = response.body.decode('utf-8')
-                callback(TrombiResult(json.loads(body)))
+            callback(TrombiResult(self.codec.loads(response.body)))
 
-        stream_buffer = []
+        self._fetch(url, _really_callback)
+        return future
 
-        def _stream(text):
-            stream_buffer.append(text.decode('utf-8'))
-            chunks = ''.join(stream_buffer).split('\n')
 
-            # The last chunk is either an empty string or an
-            # incomplete line. Save it for the next round. The [:]
-            # syntax is used because of variable scoping.
-            stream_buffer[:] = [chunks.pop()]
+class _LineBuffer(object):
+    """
+    Splits a byte stream to lines. Each chunk is scanned only once
+    and the consumed lines are removed from the front of the buffer,
+    so the cost is linear in the length of the stream.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        # Everything before this has been searched for newlines
+        self._scan = 0
+
+    def feed(self, data):
+        buf = self._buffer
+        buf += data
+        lines = []
+        start = 0
+        end = buf.find(b'\n', self._scan)
+        while end != -1:
+            if end > start:
+                lines.append(bytes(buf[start:end]))
+            start = end + 1
+            end = buf.find(b'\n', start)
+        if start:
+            del buf[:start]
+        self._scan = len(buf)
+        return lines
+
+
+class ChangesFeed(TrombiObject):
+    """
+    A continuous changes feed, returned by :meth:`Database.changes`
+    and :meth:`Server.db_updates`.
+    """
+    def __init__(self, server, callback, batch=False, batch_window=None,
+                 max_queue=None):
+        self.server = server
+        self.callback = callback
+        self.batch = batch or batch_window is not None
+        self.batch_window = batch_window
+        self.max_queue = max_queue
+        self.last_seq = None
+        self.last_activity = time.time()
+        # Whether any data, heartbeats included, has arrived
+        self.received = False
+        self.closed = False
+        self.paused = False
+        self.overflowed = False
+        # The number of changes received but not delivered yet
+        self.queued = 0
+        self._lines = _LineBuffer()
+        self._batch = ChangesBatch()
+        self._batch_timeout = None
+        self._queue = collections.deque()
+        self._scheduled = False
+
+    def close(self):
+        # Tornado can't abort a request, so the connection is dropped
+        # by failing the streaming callback when data arrives next,
+        # at the latest with the next heartbeat
+        self.closed = True
+
+    def pause(self):
+        """
+        Stops delivering changes until resume() is called.
+        """
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._schedule()
+
+    def _stream(self, data):
+        if self.closed:
+            raise _FeedClosed()
+        self.last_activity = time.time()
+        self.received = True
+
+        for line in self._lines.feed(data):
+            if not line.strip():
+                # Heartbeat
+                continue
+
+            if (self.max_queue is not None and
+                self.queued + len(self._batch) >= self.max_queue):
+                # Tornado keeps on reading the socket no matter what,
+                # so drop the connection. The consumer reconnects
+                # from the last change it has processed.
+                self.overflowed = True
+                self.closed = True
+                self._flush_batch()
+                raise _FeedClosed()
 
-            for chunk in chunks:
-                if not chunk.strip():
-                    continue
+            try:
+                obj = self.server.codec.loads(line)
+            except ValueError:
+                # JSON parsing failed. Apparently we have some
+                # gibberish on our hands, just discard it.
+                log.warning('Invalid changes feed line: %r' % line)
+                continue
+
+            if 'seq' in obj:
+                self.last_seq = obj['seq']
+            elif 'last_seq' in obj:
+                self.last_seq = obj['last_seq']
+
+            if self.batch:
+                # The last_seq line at the end of the feed is not a
+                # change
+                if 'last_seq' not in obj:
+                    self._batch.append(obj)
+                self._batch.last_seq = self.last_seq
+                continue
+
+            self._deliver(TrombiDict(obj), 1)
+
+        if not self._batch:
+            return
+        if self.batch_window is None:
+            self._flush_batch()
+        elif self._batch_timeout is None:
+            self._batch_timeout = self.server.io_loop.add_timeout(
+                time.time() + self.batch_window, self._flush_batch)
+
+    def _flush_batch(self):
+        if self._batch_timeout is not None:
+            self.server.io_loop.remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+        if self._batch:
+            batch, self._batch = self._batch, ChangesBatch()
+            self._deliver(batch, len(batch))
+
+    def _deliver(self, item, count):
+        self._queue.append((item, count))
+        self.queued += count
+        self._schedule()
+
+    def _schedule(self):
+        # "Escape" the streaming_callback context by invoking the
+        # handler as an ioloop callback. This makes it possible to
+        # start new HTTP requests in the handler (it is impossible in
+        # the streaming_callback context).
+        #
+        # This also relieves us from handling exceptions in the
+        # handler.
+        if self._queue and not self.paused and not self._scheduled:
+            self._scheduled = True
+            self.server.io_loop.add_callback(self._dispatch)
+
+    def _dispatch(self):
+        self._scheduled = False
+        try:
+            while self._queue and not self.paused:
+                item, count = self._queue.popleft()
+                self.queued -= count
+                self.callback(item)
+        finally:
+            self._schedule()
+
+    def _done(self, response):
+        log.debug('Changes feed response: %s', response)
+        self._flush_batch()
+        if self.overflowed:
+            result = TrombiErrorResponse(trombi.errors.QUEUE_FULL,
+                                         'Changes queue is full')
+        elif response.code != 200 and not self.closed:
+            result = _error_response(response)
+        else:
+            # Feed terminated, call callback with None to indicate
+            # this
+            result = None
+        self._deliver(result, 0)
 
-                try:
-                    obj = json.loads(chunk)
-                except ValueError:
-                    # JSON parsing failed. Apparently we have some
-                    # gibberish on our hands, just discard it.
-                    log.warning('Invalid changes feed line: %s' % chunk)
-                    continue
-
-                # "Escape" the streaming_callback context by invoking
-                # the handler as an ioloop callback. This makes it
-                # possible to start new HTTP requests in the handler
-                # (it is impossible in the streaming_callback
-                # context). Tornado runs these callbacks in the order
-                # they were added, so this works correctly.
-                #
-                # This also relieves us from handling exceptions in
-                # the handler.
-                cb = functools.partial(callback, TrombiDict(obj))
-                self.server.io_loop.add_callback(cb)
 
-        couchdb_params = kw
-        couchdb_params['feed'] = feed
-        if timeout is not None:
-            # CouchDB takes timeouts in milliseconds
-            couchdb_params['timeout'] = timeout * 1000
-        url = '_changes?%s' % urlencode(couchdb_params)
-        params = dict()
-        if feed == 'continuous':
-            params['streaming_callback'] = _stream
+class ChangesBatch(TrombiObject, list):
+    """
+    A list of changes delivered at once, with the last seq of the
+    batch as last_seq.
+    """
+    last_seq = None
+
 
-        log.debug('Fetching changes from %s with params %s', url, params)
-        self._fetch(url, _really_callback, **params)
+class _FeedClosed(Exception):
+    pass
 
 
 class Document(collections.MutableMapping, TrombiObject):
+    __slots__ = ('db', 'id', 'rev', 'attachments', '_data', '_meta',
+                 '_raw_cache', '_dirty', '_postponed_attachments')
+
     def __init__(self, db, data):
+        self._load(db, dict(data))
+
+    @classmethod
+    def _from_json(cls, db, data):
+        # Adopt a freshly decoded dict instead of copying it
+        doc = cls.__new__(cls)
+        doc._load(db, data)
+        doc._dirty = False
+        return doc
+
+    def _load(self, db, data):
         self.db = db
-        self.data = {}
         self.id = None
         self.rev = None
-        self._postponed_attachments = False
         self.attachments = {}
+        self._meta = None
+        self._raw_cache = None
+        self._dirty = True
+        self._postponed_attachments = False
 
-        for key, value in data.items():
-            if key.startswith('_'):
-                setattr(self, key[1:], value)
+        reserved = [key for key in data if key.startswith('_')]
+        for key in reserved:
+            value = data.pop(key)
+            if key == '_id':
+                self.id = value
+            elif key == '_rev':
+                self.rev = value
+            elif key == '_attachments':
+                self.attachments = value
             else:
-                self[key] = value
+                # Other CouchDB fields, like _deleted or _conflicts
+                if self._meta is None:
+                    self._meta = {}
+                self._meta[key[1:]] = value
+        self._data = data
+
+    def __getattr__(self, name):
+        if not name.startswith('_') and self._meta and name in self._meta:
+            return self._meta[name]
+        raise AttributeError(name)
+
+    @property
+    def data(self):
+        # The dict can be modified through this, so the cached raw
+        # document can't be trusted anymore
+        self._raw_cache = None
+        self._dirty = True
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._raw_cache = None
+        self._dirty = True
+        self._data = value
+
+    @property
+    def dirty(self):
+        """
+        True if the document may have been modified after it was
+        loaded or saved.
+        """
+        return self._dirty
+
+    @dirty.setter
+    def dirty(self, value):
+        self._dirty = value
 
     def __len__(self):
-        return len(self.data)
+        return len(self._data)
 
     def __iter__(self):
-        return iter(self.data)
+        return iter(self._data)
 
     def __contains__(self, key):
-        return key in self.data
+        return key in self._data
 
     def __getitem__(self, key):
-        return self.data[key]
+        value = self._data[key]
+        if isinstance(value, (dict, list)):
+            # The value can be modified without us knowing
+            self._dirty = True
+        return value
 
     def __setitem__(self, key, value):
         if key.startswith('_'):
             raise KeyError("Keys starting with '_' are reserved for CouchDB")
-        self.data[key] = value
+        self._raw_cache = None
+        self._dirty = True
+        self._data[key] = value
 
     def __delitem__(self, key):
-        del self.data[key]
+        self._raw_cache = None
+        self._dirty = True
+        del self._data[key]
+
+    def _raw(self):
+        # The merged dict is kept until a key of the document is set
+        # or deleted. Nested values are shared with the document.
+        raw = self._raw_cache
+        if raw is None:
+            raw = self._raw_cache = dict(self._data)
+        for key, value in (('_id', self.id),
+                           ('_rev', self.rev),
+                           ('_attachments', self.attachments)):
+            if value:
+                raw[key] = value
+            else:
+                raw.pop(key, None)
+        return raw
 
     def raw(self):
-        result = {}
-        if self.id:
-            result['_id'] = self.id
-        if self.rev:
-            result['_rev'] = self.rev
-        if self.attachments:
-            result['_attachments'] = self.attachments
-
-        result.update(self.data)
-        return result
+        return dict(self._raw())
 
-    def copy(self, new_id, callback):
+    def copy(self, new_id, callback=None):
+        callback, future = _future_callback(callback)
         assert self.rev and self.id
 
         def _copy_done(response):
@@ -740,11 +1976,13 @@ class Document(collections.MutableMapping, TrombiObject):
                 callback(_error_response(response))
                 return
 
-            content = json.loads(response.body.decode('utf-8'))
-            doc = Document(self.db, self.data)
+            content = self.db.codec.loads(response.body)
+            doc = Document(self.db, self._data)
             doc.attachments = self.attachments.copy()
             doc.id = content['id']
             doc.rev = content['rev']
+            doc.dirty = False
+            self.db._invalidate(doc.id)
             callback(doc)
 
         self.db._fetch(
@@ -754,15 +1992,19 @@ class Document(collections.MutableMapping, TrombiObject):
             method='COPY',
             headers={'Destination': str(new_id)}
             )
+        return future
+
+    def attach(self, name, data, callback=None, type='text/plain'):
+        callback, future = _future_callback(callback)
 
-    def attach(self, name, data, callback, type='text/plain'):
         def _really_callback(response):
             if  response.code != 201:
                 callback(_error_response(response))
                 return
-            data = json.loads(response.body.decode('utf-8'))
+            data = self.db.codec.loads(response.body)
             assert data['id'] == self.id
             self.rev = data['rev']
+            self.db._invalidate(self.id)
             self.attachments[name] = {
                 'content_type': type,
                 'length': len(data),
@@ -782,8 +2024,11 @@ class Document(collections.MutableMapping, TrombiObject):
             body=data,
             headers=headers,
             )
+        return future
+
+    def load_attachment(self, name, callback=None):
+        callback, future = _future_callback(callback)
 
-    def load_attachment(self, name, callback):
         def _really_callback(response):
             if response.code == 200:
                 callback(response.body)
@@ -803,12 +2048,16 @@ class Document(collections.MutableMapping, TrombiObject):
                     ),
                 _really_callback,
                 )
+        return future
+
+    def delete_attachment(self, name, callback=None):
+        callback, future = _future_callback(callback)
 
-    def delete_attachment(self, name, callback):
         def _really_callback(response):
             if response.code != 200:
                 callback(_error_response(response))
                 return
+            self.db._invalidate(self.id)
             callback(self)
 
         self.db._fetch(
@@ -816,6 +2065,7 @@ class Document(collections.MutableMapping, TrombiObject):
             _really_callback,
             method='DELETE',
             )
+        return future
 
 
 class BulkError(TrombiError):
@@ -861,6 +2111,89 @@ class BulkResult(TrombiResult, collections.Sequence):
         return self.content[key]
 
 
+# Marks the fields missing from a ViewRow
+_MISSING = object()
+
+_VIEW_ROW_FIELDS = {
+    'id': '_id',
+    'key': '_key',
+    'value': '_value',
+    'doc': '_doc',
+    'error': '_error',
+    }
+
+
+class ViewRow(collections.MutableMapping):
+    """
+    A row of ViewResult. Behaves like the row object returned by
+    CouchDB, but stores the fields in slots instead of a dict and
+    creates the Document of the doc field only once, when it's first
+    accessed.
+    """
+    __slots__ = ('_db', '_id', '_key', '_value', '_doc', '_error', '_extra')
+
+    def __init__(self, row, db=None):
+        self._db = db
+        self._extra = None
+        found = 0
+        for key, attr in _VIEW_ROW_FIELDS.items():
+            value = row.get(key, _MISSING)
+            if value is not _MISSING:
+                found += 1
+            setattr(self, attr, value)
+        if found < len(row):
+            self._extra = dict((key, value) for key, value in row.items()
+                               if key not in _VIEW_ROW_FIELDS)
+
+    def __getitem__(self, key):
+        attr = _VIEW_ROW_FIELDS.get(key)
+        if attr is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+
+        value = getattr(self, attr)
+        if value is _MISSING:
+            raise KeyError(key)
+        if attr == '_doc' and value and isinstance(value, dict):
+            value = self._doc = Document._from_json(self._db, value)
+        return value
+
+    def __setitem__(self, key, value):
+        attr = _VIEW_ROW_FIELDS.get(key)
+        if attr is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        else:
+            setattr(self, attr, value)
+
+    def __delitem__(self, key):
+        attr = _VIEW_ROW_FIELDS.get(key)
+        if attr is None:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+        elif getattr(self, attr) is _MISSING:
+            raise KeyError(key)
+        else:
+            setattr(self, attr, _MISSING)
+
+    def __iter__(self):
+        for key, attr in _VIEW_ROW_FIELDS.items():
+            if getattr(self, attr) is not _MISSING:
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return 'ViewRow(%r)' % dict(self.items())
+
+
 class ViewResult(TrombiObject, collections.Sequence):
     def __init__(self, result, db=None):
         self.db = db
@@ -868,19 +2201,132 @@ class ViewResult(TrombiObject, collections.Sequence):
         self._rows = result['rows']
         self.offset = result.get('offset', 0)
 
-    def _format_row(self, row):
-        if 'doc' in row and row['doc']:
-            row['doc'] = Document(self.db, row['doc'])
+    def _format_row(self, index):
+        # Rows are converted to ViewRows on first access
+        row = self._rows[index]
+        if not isinstance(row, ViewRow):
+            row = self._rows[index] = ViewRow(row, self.db)
         return row
 
     def __len__(self):
         return len(self._rows)
 
     def __iter__(self):
-        return (self._format_row(x) for x in self._rows)
+        return (self._format_row(i) for i in range(len(self._rows)))
 
     def __getitem__(self, key):
-        return self._format_row(self._rows[key])
+        if isinstance(key, slice):
+            return [self._format_row(i)
+                    for i in range(*key.indices(len(self._rows)))]
+        return self._format_row(key)
+
+    def to_columns(self, dtype=None):
+        """
+        Returns the rows as a dict of NumPy arrays: keys as an object
+        array, values as an array of dtype (inferred if not given)
+        and ids, if the view has them, as a string array.
+        """
+        if numpy is None:
+            raise ImportError('NumPy is required for to_columns')
+
+        count = len(self._rows)
+        keys = numpy.empty(count, dtype=object)
+        values = []
+        ids = []
+        # Read the rows as they are, without converting them to
+        # ViewRows
+        for i, row in enumerate(self._rows):
+            keys[i] = row.get('key')
+            values.append(row.get('value'))
+            ids.append(row.get('id'))
+
+        if dtype is None:
+            values = numpy.array(values)
+        else:
+            values = numpy.fromiter(values, dtype, count)
+        columns = {'key': keys, 'value': values}
+        if any(x is not None for x in ids):
+            columns['id'] = numpy.array(
+                [x if x is not None else '' for x in ids], dtype=str)
+        return columns
+
+
+_VIEW_ROWS_START = re.compile(r'"rows"\s*:\s*\[')
+
+
+class _ViewStreamParser(object):
+    """Incremental parser for view responses.
+
+    Rows are decoded one by one as soon as they have arrived in full,
+    so only the unparsed tail of the response is kept in memory.
+    Everything before the rows array is available as ``header``.
+    """
+    def __init__(self):
+        self.header = None
+        self.done = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        # Data received after the last newline, joined to the buffer
+        # once a newline arrives
+        self._tail = []
+
+    def pending(self):
+        return (self._buffer + ''.join(self._tail)).encode('utf-8')
+
+    def feed(self, data, final=False):
+        text = self._decoder.decode(data, final)
+        self._tail.append(text)
+        # CouchDB ends every row with a newline. Until one arrives,
+        # only collect the data, so that a large row is neither copied
+        # nor scanned again for every chunk.
+        if not final and '\n' not in text:
+            return []
+        buf = self._buffer + ''.join(self._tail)
+        self._tail = []
+
+        if self.header is None:
+            match = _VIEW_ROWS_START.search(buf)
+            if match is None:
+                self._buffer = buf
+                return []
+            head = buf[:match.start()].rstrip().rstrip(',')
+            self.header = json.loads(head + '}')
+            buf = buf[match.end():]
+
+        rows = []
+        pos = 0
+        while not self.done:
+            while pos < len(buf) and buf[pos] in ', \t\r\n':
+                pos += 1
+            if pos == len(buf):
+                break
+            if buf[pos] == ']':
+                self.done = True
+                pos += 1
+                break
+            # Don't try to decode a row before its newline has
+            # arrived, the row would only be decoded again later
+            if not final and buf.find('\n', pos) == -1:
+                break
+            try:
+                row, end = self._json.raw_decode(buf, pos)
+            except ValueError:
+                if final:
+                    raise
+                break
+            rows.append(row)
+            pos = end
+        self._buffer = buf[pos:]
+        return rows
+
+    def close(self):
+        if self.done:
+            return []
+        rows = self.feed(b'', final=True)
+        if not self.done:
+            raise ValueError('View response ended before all rows')
+        return rows
 
 
 class Paginator(TrombiObject):
@@ -907,7 +2353,7 @@ class Paginator(TrombiObject):
         self.start_doc_id = None
         self.end_doc_id = None
 
-    def get_page(self, design_doc, viewname, callback,
+    def get_page(self, design_doc, viewname, callback=None,
             key=None, doc_id=None, forward=True, **kw):
         """
         On success, callback is called with this Paginator object as an
@@ -923,6 +2369,8 @@ class Paginator(TrombiObject):
         from the _first_ document on the current page.
 
         """
+        callback, future = _future_callback(callback)
+
         def _really_callback(response):
             if response.error:
                 # Send the received Database.view error to the callback
@@ -972,6 +2420,1102 @@ class Paginator(TrombiObject):
             kwargs['skip'] = 1
 
         self._db.view(design_doc, viewname, _really_callback, **kwargs)
+        return future
+
+
+class ViewIterator(TrombiObject):
+    """
+    Iterates over all rows of a view, fetching batch_size rows at a
+    time. The next batch is requested with startkey and
+    startkey_docid taken from the last row instead of skip, and it is
+    prefetched while the current one is being consumed.
+    """
+    def __init__(self, db, design_doc, viewname, batch_size=100, **params):
+        if 'keys' in params or 'skip' in params:
+            raise TypeError('iterview does not support keys or skip')
+        self.db = db
+        self._design_doc = design_doc
+        self._viewname = viewname
+        self._batch_size = batch_size
+        self._limit = params.pop('limit', None)
+        self._params = params
+        self._start = None
+        self._rows = collections.deque()
+        self._waiting = collections.deque()
+        self._fetching = False
+        self._exhausted = False
+        self._error = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = Future()
+
+        def _callback(row):
+            if row is None:
+                future.set_exception(StopAsyncIteration())
+            elif isinstance(row, TrombiErrorResponse):
+                future.set_exception(
+                    trombi.errors.exception_for(row.errno, row.msg))
+            else:
+                future.set_result(row)
+
+        self.next(_callback)
+        return future
+
+    def next(self, callback=None):
+        """
+        Calls callback with the next row of the view, or None when
+        all rows have been read.
+        """
+        callback, future = _future_callback(callback)
+        self._waiting.append(callback)
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        io_loop = self.db.server.io_loop
+        while self._waiting and self._rows:
+            row = self._rows.popleft()
+            if self._limit is not None:
+                self._limit -= 1
+            io_loop.add_callback(functools.partial(self._waiting.popleft(),
+                                                   row))
+
+        if self._waiting and not self._rows and not self._fetching:
+            if self._error is not None:
+                self._finish(self._error)
+            elif self._exhausted or self._limit == 0:
+                self._finish(None)
+
+        # Keep at most one batch buffered in addition to the one
+        # being consumed
+        if (not self._fetching and not self._exhausted and
+            self._error is None and
+            (self._limit is None or len(self._rows) < self._limit) and
+            len(self._rows) <= self._batch_size):
+            self._fetch_batch()
+
+    def _finish(self, result):
+        while self._waiting:
+            self.db.server.io_loop.add_callback(
+                functools.partial(self._waiting.popleft(), result))
+
+    def _fetch_batch(self):
+        params = dict(self._params)
+        # One extra row tells where the next batch starts
+        params['limit'] = self._batch_size + 1
+        if self._start is not None:
+            params['startkey'], doc_id = self._start
+            if doc_id is not None:
+                params['startkey_docid'] = doc_id
+        self._fetching = True
+        self.db.view(self._design_doc, self._viewname, self._batch_cb,
+                     **params)
+
+    def _batch_cb(self, result):
+        self._fetching = False
+        if result.error:
+            self._error = result
+        else:
+            rows = list(result)
+            if len(rows) > self._batch_size:
+                last = rows.pop()
+                # Rows of reduced views have no id, but their keys are
+                # unique
+                self._start = (last['key'], last.get('id'))
+            else:
+                self._exhausted = True
+            if self._limit is not None:
+                rows = rows[:self._limit - len(self._rows)]
+            self._rows.extend(rows)
+        self._dispatch()
+
+
+class DocumentLoader(TrombiObject):
+    """
+    Coalesces :meth:`Database.get` calls made close to each other into
+    a single ``_all_docs`` request.
+    """
+    def __init__(self, db, delay=0, max_keys=1000):
+        self.db = db
+        self.delay = delay
+        self.max_keys = max_keys
+        self._pending = []
+        self._flush_scheduled = False
+
+    def get(self, doc_id, callback=None):
+        """
+        Loads the document *doc_id*. On success, calls *callback* with
+        :class:`Document`, or *None* if the document doesn't exist.
+        """
+        callback, future = _future_callback(callback)
+
+        self._pending.append((doc_id, callback))
+        if len(self._pending) >= self.max_keys:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            io_loop = self.db.server.io_loop
+            if self.delay:
+                io_loop.add_timeout(time.time() + self.delay, self.flush)
+            else:
+                # Collect the calls made during this IOLoop iteration
+                io_loop.add_callback(self.flush)
+        return future
+
+    def flush(self):
+        """
+        Sends the pending requests right away.
+        """
+        self._flush_scheduled = False
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        def _really_callback(result):
+            if result.error:
+                for doc_id, callback in pending:
+                    callback(result)
+                return
+
+            # The rows are in the order of the keys, duplicate keys
+            # included, so every caller gets a Document of its own
+            for row, (doc_id, callback) in zip(result, pending):
+                # Missing documents have an error and deleted ones a
+                # null doc. A Document with only _id and _rev is an
+                # empty mapping, so don't test for truth.
+                if 'error' in row:
+                    callback(None)
+                else:
+                    callback(row.get('doc'))
+
+        self.db.view(None, '_all_docs', _really_callback,
+                     keys=[doc_id for doc_id, callback in pending],
+                     include_docs=True)
+
+
+# Bulk API error types with a matching error code
+_BULK_ERRORS = {
+    'conflict': trombi.errors.CONFLICT,
+    'forbidden': trombi.errors.FORBIDDEN,
+    'not_found': trombi.errors.NOT_FOUND,
+    }
+
+
+class BulkWriter(TrombiObject):
+    """
+    Buffers :meth:`Database.set` calls and writes them with
+    :meth:`Database.bulk_docs`.
+    """
+    def __init__(self, db, max_docs=100, delay=0.01):
+        self.db = db
+        self.max_docs = max_docs
+        self.delay = delay
+        self._pending = []
+        self._timeout = None
+
+    def set(self, *args, **kwargs):
+        """
+        Saves a document like :meth:`Database.set` (without inline
+        attachments), once the buffer is flushed.
+        """
+        doc_id, data, callback = _set_args(
+            'BulkWriter.set', args, kwargs.pop('callback', None))
+        if kwargs:
+            raise TypeError(
+                '%s is invalid keyword argument for this function' %
+                list(kwargs.keys())[0])
+        callback, future = _future_callback(callback)
+
+        if isinstance(data, Document):
+            doc = data
+        else:
+            doc = Document(self.db, data)
+        if doc_id is not None:
+            doc.id = doc_id
+
+        self._pending.append((doc, callback))
+        if len(self._pending) >= self.max_docs:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = self.db.server.io_loop.add_timeout(
+                time.time() + self.delay, self.flush)
+        return future
+
+    def flush(self):
+        """
+        Writes the buffered documents right away.
+        """
+        if self._timeout is not None:
+            self.db.server.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        def _really_callback(result):
+            if result.error:
+                for doc, callback in pending:
+                    callback(result)
+                return
+
+            for item, (doc, callback) in zip(result, pending):
+                if item.error:
+                    errno = _BULK_ERRORS.get(
+                        item.error_type, trombi.errors.SERVER_ERROR)
+                    callback(TrombiErrorResponse(
+                        errno, item.reason or item.error_type))
+                else:
+                    doc.id = item['id']
+                    doc.rev = item['rev']
+                    callback(doc)
+
+        self.db.bulk_docs([doc for doc, callback in pending],
+                          _really_callback)
+
+
+class DocumentCache(TrombiObject):
+    """
+    Caches document bodies for :meth:`Database.get`, keeping at most
+    max_docs documents and max_bytes bytes. The least recently used
+    documents are evicted first. Cached documents are revalidated
+    with If-None-Match and served from the cache on 304.
+    """
+    def __init__(self, max_docs=1000, max_bytes=None):
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Set by CacheInvalidator while it is following the changes
+        self.coherent = False
+        # Bumped on every invalidation, so that a response read
+        # before the invalidation won't be stored
+        self.generation = 0
+        # doc_id -> (etag, body), least recently used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._entries
+
+    def lookup(self, doc_id):
+        """
+        Returns the (etag, body) tuple of a cached document or None.
+        """
+        entry = self._entries.pop(doc_id, None)
+        if entry is not None:
+            self._entries[doc_id] = entry
+        return entry
+
+    def store(self, doc_id, etag, body):
+        entry = self._entries.pop(doc_id, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+        if self.max_bytes is not None and len(body) > self.max_bytes:
+            return
+        self._entries[doc_id] = (etag, body)
+        self._bytes += len(body)
+        while (len(self._entries) > self.max_docs or
+               (self.max_bytes is not None and
+                self._bytes > self.max_bytes)):
+            _, (etag, body) = self._entries.popitem(last=False)
+            self._bytes -= len(body)
+
+    def invalidate(self, doc_id):
+        self.generation += 1
+        entry = self._entries.pop(doc_id, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        return {
+            'docs': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            }
+
+
+class _ViewCacheEntry(object):
+    __slots__ = ('etag', 'body', 'expires', 'refreshing')
+
+    def __init__(self, etag, body, expires):
+        self.etag = etag
+        self.body = body
+        self.expires = expires
+        self.refreshing = False
+
+
+class ViewCache(TrombiObject):
+    """
+    Caches view results for :meth:`Database.view` by the view url and
+    query. Results are served from the cache for ttl seconds, after
+    which they are revalidated with the ETag of the view.
+    """
+    def __init__(self, ttl=60, max_entries=100, stale_while_revalidate=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_while_revalidate = stale_while_revalidate
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        # (url, body) -> _ViewCacheEntry, least recently used first
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entries[key] = entry
+        return entry
+
+    def store(self, key, etag, body):
+        self._entries.pop(key, None)
+        self._entries[key] = _ViewCacheEntry(etag, body,
+                                             time.time() + self.ttl)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            }
+
+
+class CacheInvalidator(TrombiObject):
+    """
+    Follows the changes feed of a database and removes the changed
+    documents from the :class:`DocumentCache` of the database. While
+    the feed is followed, the cache is marked coherent and cached
+    documents are served without asking CouchDB.
+    """
+    def __init__(self, db, since='now', heartbeat=10, retry_delay=1,
+                 refresh=False):
+        self.db = db
+        self.last_seq = since
+        self.heartbeat = heartbeat
+        self.retry_delay = retry_delay
+        self.refresh = refresh
+        self.running = False
+        # Identifies the current feed, changes from older feeds are
+        # ignored
+        self._feed_id = 0
+        self._feed = None
+        self._timeout = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if self.db.cache is not None:
+            # Anything cached so far may have changed unnoticed
+            self.db.cache.clear()
+        self._connect()
+
+    def stop(self):
+        self.running = False
+        self._feed_id += 1
+        self._set_coherent(False)
+        if self._feed is not None:
+            self._feed.close()
+            self._feed = None
+        if self._timeout is not None:
+            self.db.server.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _set_coherent(self, coherent):
+        if self.db.cache is not None:
+            self.db.cache.coherent = coherent
+
+    def _connect(self):
+        self._timeout = None
+        self._feed_id += 1
+        feed_id = self._feed_id
+
+        def _caught_up(result):
+            if feed_id != self._feed_id:
+                return
+            if result.error:
+                self._reconnect(result)
+                return
+            for change in result.content['results']:
+                self._change(change)
+            self.last_seq = result.content['last_seq']
+
+            # Changes made from now on come through the continuous
+            # feed
+            self._set_coherent(True)
+            self._feed = self.db.changes(
+                _change, feed='continuous', since=self.last_seq,
+                heartbeat=int(self.heartbeat * 1000))
+
+        def _change(change):
+            if feed_id != self._feed_id:
+                return
+            if change is None or change.error:
+                self._reconnect(change)
+            elif 'last_seq' in change:
+                self.last_seq = change['last_seq']
+            else:
+                self._change(change)
+
+        # Fetch the changes made since last_seq first, the
+        # continuous feed doesn't tell when it has caught up
+        self.db.changes(_caught_up, since=self.last_seq)
+
+    def _change(self, change):
+        self.last_seq = change['seq']
+        if self.db.view_cache is not None:
+            # Any change may change the view results
+            self.db.view_cache.clear()
+        cache = self.db.cache
+        if cache is None:
+            return
+        doc_id = change['id']
+        cached = doc_id in cache
+        # Bumps the generation even if the document isn't cached, so
+        # that a response to a GET sent before the change isn't stored
+        cache.invalidate(doc_id)
+        if cached and self.refresh and not change.get('deleted'):
+            self.db.get(doc_id, lambda doc: None)
+
+    def _reconnect(self, error):
+        self._set_coherent(False)
+        if error is not None:
+            log.warning('Changes feed of %s failed: %s',
+                        self.db.name, error.msg)
+        self._feed_id += 1
+        self._feed = None
+        if self.running:
+            self._timeout = self.db.server.io_loop.add_timeout(
+                time.time() + self.retry_delay, self._connect)
+
+
+class LocalDocCheckpoint(TrombiObject):
+    """
+    Stores the checkpoint of a :class:`ChangesFollower` in a local
+    document (_local/name), which is not replicated.
+    """
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self._url = '_local/%s' % urlquote(name, safe='')
+        self._rev = None
+
+    def load(self, callback):
+        def _really_callback(response):
+            if response.code == 200:
+                data = self.db.codec.loads(response.body)
+                self._rev = data.get('_rev')
+                callback(data.get('seq'))
+            elif response.code == 404:
+                callback(None)
+            else:
+                callback(_error_response(response))
+
+        self.db._fetch(self._url, _really_callback)
+
+    def save(self, seq, callback):
+        def _really_callback(response):
+            if response.code == 201:
+                self._rev = self.db.codec.loads(response.body)['rev']
+                callback(TrombiObject())
+            elif response.code == 409 and not retried:
+                # Someone else saved it, take over their revision
+                retried.append(True)
+                self.load(lambda result: _put())
+            else:
+                callback(_error_response(response))
+
+        def _put():
+            data = {'seq': seq}
+            if self._rev is not None:
+                data['_rev'] = self._rev
+            self.db._fetch(self._url, _really_callback, method='PUT',
+                           body=self.db.codec.dumps(data))
+
+        retried = []
+        _put()
+
+
+class FileCheckpoint(TrombiObject):
+    """
+    Stores the checkpoint of a :class:`ChangesFollower` in a local
+    file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, callback):
+        try:
+            with open(self.path) as f:
+                seq = json.load(f).get('seq')
+        except (IOError, OSError):
+            seq = None
+        except ValueError:
+            log.warning('Invalid checkpoint file %s', self.path)
+            seq = None
+        callback(seq)
+
+    def save(self, seq, callback):
+        # Replace the file atomically so that a crash can't leave a
+        # truncated checkpoint behind
+        tmp = '%s.tmp' % self.path
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'seq': seq}, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            callback(TrombiErrorResponse(
+                trombi.errors.SERVER_ERROR,
+                'Unable to save checkpoint: %s' % e))
+        else:
+            callback(TrombiObject())
+
+
+class ChangesFollower(TrombiObject):
+    """
+    Follows the continuous changes feed of a database, reconnecting
+    when the feed ends, fails or stalls, and resuming from the last
+    acknowledged seq. The seq is saved periodically to checkpoint,
+    from where it is loaded on start.
+    """
+    def __init__(self, db, callback, checkpoint=None, since=0,
+                 heartbeat=10, stall_timeout=None, checkpoint_interval=5,
+                 auto_ack=True, retry_policy=None, batch=False,
+                 batch_window=None, **params):
+        self.db = db
+        self.callback = callback
+        self.checkpoint = checkpoint
+        self.last_seq = since
+        self.saved_seq = None
+        self.heartbeat = heartbeat
+        if stall_timeout is None:
+            stall_timeout = heartbeat * 3
+        self.stall_timeout = stall_timeout
+        self.checkpoint_interval = checkpoint_interval
+        self.auto_ack = auto_ack
+        if retry_policy is None:
+            retry_policy = RetryPolicy(backoff_base=1, backoff_max=60)
+        self.retry_policy = retry_policy
+        self.running = False
+        self.paused = False
+        # Set when the feed overflowed while paused
+        self._reconnect_on_resume = False
+        self._feed_params = dict(params, batch=batch,
+                                 batch_window=batch_window)
+        self._feed = None
+        # Identifies the current feed, changes from abandoned feeds
+        # are ignored
+        self._feed_id = 0
+        self._failures = 0
+        self._saving = False
+        self._timeouts = {}
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+
+        def _loaded(seq):
+            if isinstance(seq, TrombiErrorResponse):
+                log.warning('Loading checkpoint failed: %s', seq.msg)
+                self._failures += 1
+                self._schedule('connect', self._failure_delay(), self.start)
+                self.running = False
+                return
+            if seq is not None:
+                self.last_seq = self.saved_seq = seq
+            self._connect()
+            self._schedule('checkpoint', self.checkpoint_interval,
+                           self._save)
+            self._schedule('watchdog', self.heartbeat, self._watch)
+
+        if self.checkpoint is not None:
+            self.checkpoint.load(_loaded)
+        else:
+            _loaded(None)
+
+    def stop(self):
+        """
+        Stops following the feed and saves the checkpoint.
+        """
+        self.running = False
+        self._abandon()
+        for timeout in self._timeouts.values():
+            self.db.server.io_loop.remove_timeout(timeout)
+        self._timeouts.clear()
+        self._save()
+
+    def ack(self, seq):
+        """
+        Marks the changes up to seq processed.
+        """
+        self.last_seq = seq
+
+    def pause(self):
+        """
+        Stops delivering changes until resume() is called.
+        """
+        self.paused = True
+        if self._feed is not None:
+            self._feed.pause()
+
+    def resume(self):
+        self.paused = False
+        if self._feed is not None:
+            self._feed.resume()
+        elif self._reconnect_on_resume:
+            self._reconnect_on_resume = False
+            self._connect()
+
+    def _schedule(self, name, delay, callback):
+        io_loop = self.db.server.io_loop
+        if name in self._timeouts:
+            io_loop.remove_timeout(self._timeouts[name])
+
+        def _run():
+            del self._timeouts[name]
+            callback()
+
+        self._timeouts[name] = io_loop.add_timeout(time.time() + delay, _run)
+
+    def _failure_delay(self):
+        return self.retry_policy.delay(self._failures)
+
+    def _connect(self):
+        if not self.running:
+            return
+        self._feed_id += 1
+        feed_id = self._feed_id
+
+        def _change(change):
+            if feed_id != self._feed_id:
+                return
+            if change is None:
+                # CouchDB closed the feed, carry on
+                self._abandon()
+                self._schedule('connect', 0, self._connect)
+                return
+            if (change.error and
+                change.errno == trombi.errors.QUEUE_FULL):
+                # The changes came in faster than they were consumed
+                # and the feed was dropped. Continue from the last
+                # acknowledged change once we are not paused.
+                self._abandon()
+                if self.paused:
+                    self._reconnect_on_resume = True
+                else:
+                    self._schedule('connect', 0, self._connect)
+                return
+            if change.error:
+                log.warning('Changes feed of %s failed: %s',
+                            self.db.name, change.msg)
+                if self._feed.received:
+                    # The connection worked, start backing off anew
+                    self._failures = 0
+                self._abandon()
+                self._failures += 1
+                self._schedule('connect', self._failure_delay(),
+                               self._connect)
+                return
+
+            self._failures = 0
+            if isinstance(change, ChangesBatch):
+                seq = change.last_seq
+                if change:
+                    self.callback(change)
+            elif 'last_seq' in change:
+                seq = change['last_seq']
+            else:
+                seq = change['seq']
+                self.callback(change)
+            if self.auto_ack:
+                self.ack(seq)
+
+        self._feed = self.db.changes(
+            _change, feed='continuous', since=self.last_seq,
+            heartbeat=int(self.heartbeat * 1000), **self._feed_params)
+        if self.paused:
+            self._feed.pause()
+
+    def _abandon(self):
+        self._feed_id += 1
+        if self._feed is not None:
+            self._feed.close()
+            self._feed = None
+
+    def _watch(self):
+        if not self.running:
+            return
+        feed = self._feed
+        if (feed is not None and
+            time.time() - feed.last_activity > self.stall_timeout):
+            # Not even heartbeats are coming through. Give up the
+            # connection, it is closed when data arrives, if ever.
+            log.warning('Changes feed of %s stalled, reconnecting',
+                        self.db.name)
+            self._abandon()
+            self._connect()
+        self._schedule('watchdog', self.heartbeat, self._watch)
+
+    def _save(self):
+        if self.running:
+            self._schedule('checkpoint', self.checkpoint_interval,
+                           self._save)
+        if (self.checkpoint is None or self._saving or
+            self.last_seq == self.saved_seq):
+            return
+
+        seq = self.last_seq
+
+        def _saved(result):
+            self._saving = False
+            if result.error:
+                log.warning('Saving checkpoint failed: %s', result.msg)
+            else:
+                self.saved_seq = seq
+
+        self._saving = True
+        self.checkpoint.save(seq, _saved)
+
+
+class _ChangeJob(object):
+    __slots__ = ('change', 'seq', 'doc_id', 'done', 'failed')
+
+    def __init__(self, change):
+        self.change = change
+        self.seq = change['seq']
+        self.doc_id = change.get('id')
+        self.done = False
+        self.failed = False
+
+
+class ChangesProcessor(TrombiObject):
+    """
+    Runs handler for changes concurrently, at most concurrency
+    changes at a time. Changes of the same document are handled one
+    at a time in the order they were submitted. on_checkpoint is
+    called with the seq up to which all the changes have been handled.
+    A failed change is retried if on_error returns true for it, and
+    otherwise holds back the checkpoint until retry() is called.
+    """
+    def __init__(self, handler, concurrency=10, executor=None,
+                 on_checkpoint=None, on_error=None, max_pending=None,
+                 on_full=None, on_drain=None, io_loop=None):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.executor = executor
+        self.on_checkpoint = on_checkpoint
+        self.on_error = on_error
+        # on_full is called when max_pending changes are pending and
+        # on_drain when half of them have been handled
+        self.max_pending = max_pending
+        self.on_full = on_full
+        self.on_drain = on_drain
+        self.full = False
+        if io_loop is None:
+            io_loop = tornado.ioloop.IOLoop.instance()
+        self.io_loop = io_loop
+        self.last_seq = None
+        self.running = 0
+        # All unfinished jobs in submission order
+        self._jobs = collections.deque()
+        # doc_id -> unfinished jobs of the document, first one is
+        # either running or ready
+        self._by_doc = {}
+        # Jobs waiting for a free slot
+        self._ready = collections.deque()
+
+    @property
+    def pending(self):
+        """The number of changes submitted but not handled yet."""
+        return len(self._jobs)
+
+    @property
+    def failed(self):
+        """The changes that failed and haven't been retried."""
+        return [job.change for job in self._jobs if job.failed]
+
+    def retry(self):
+        """Handles the failed changes again."""
+        for job in self._jobs:
+            if job.failed:
+                job.failed = False
+                self._ready.append(job)
+        self._run()
+
+    def submit(self, change):
+        if isinstance(change, list):
+            for item in change:
+                self.submit(item)
+            return
+        if 'seq' not in change:
+            # The last_seq line of a feed
+            return
+
+        job = _ChangeJob(change)
+        self._jobs.append(job)
+        queue = self._by_doc.get(job.doc_id)
+        if queue is None:
+            self._by_doc[job.doc_id] = collections.deque([job])
+            self._ready.append(job)
+        else:
+            queue.append(job)
+        if (self.max_pending is not None and not self.full and
+            len(self._jobs) >= self.max_pending):
+            self.full = True
+            if self.on_full is not None:
+                self.on_full()
+        self._run()
+
+    def _run(self):
+        while self._ready and self.running < self.concurrency:
+            job = self._ready.popleft()
+            self.running += 1
+            self._start(job)
+
+    def _start(self, job):
+        try:
+            if self.executor is not None:
+                future = self.executor.submit(self.handler, job.change)
+            else:
+                future = self.handler(job.change)
+        except Exception as e:
+            log.exception('Handling change %s failed', job.seq)
+            self.io_loop.add_callback(
+                functools.partial(self._finish, job, error=e))
+            return
+
+        if future is None:
+            # Not calling _finish directly keeps the stack flat when
+            # the handler is synchronous
+            self.io_loop.add_callback(functools.partial(self._finish, job))
+        else:
+            self.io_loop.add_future(
+                future, functools.partial(self._finish, job))
+
+    def _finish(self, job, future=None, error=None):
+        self.running -= 1
+        if future is not None:
+            error = future.exception()
+            if error is not None:
+                log.error('Handling change %s failed: %s', job.seq, error)
+        if error is not None:
+            if self.on_error is not None and self.on_error(job.change, error):
+                self._ready.appendleft(job)
+            else:
+                # Later changes of the document wait behind this one,
+                # and the checkpoint can't move past it
+                job.failed = True
+            self._run()
+            return
+
+        job.done = True
+
+        queue = self._by_doc[job.doc_id]
+        queue.popleft()
+        if queue:
+            self._ready.append(queue[0])
+        else:
+            del self._by_doc[job.doc_id]
+
+        seq = None
+        while self._jobs and self._jobs[0].done:
+            seq = self._jobs.popleft().seq
+        if seq is not None:
+            self.last_seq = seq
+            if self.on_checkpoint is not None:
+                self.on_checkpoint(seq)
+        if self.full and len(self._jobs) <= self.max_pending // 2:
+            self.full = False
+            if self.on_drain is not None:
+                self.on_drain()
+        self._run()
+
+
+class ChangesMultiplexer(TrombiObject):
+    """
+    Watches the changes of all the databases of a server through
+    _db_updates, and fetches the changes of a database only when it
+    has been updated, using at most max_connections connections at a
+    time. callback is called with the database name and a
+    ChangesBatch of its changes.
+    """
+    def __init__(self, server, callback, max_connections=10, since=None,
+                 default_since=0, heartbeat=10, limit=None,
+                 retry_policy=None):
+        self.server = server
+        self.callback = callback
+        self.max_connections = max_connections
+        # Database name -> seq of the last change delivered
+        self.seqs = dict(since or {})
+        self.default_since = default_since
+        self.heartbeat = heartbeat
+        self.limit = limit
+        if retry_policy is None:
+            retry_policy = RetryPolicy(backoff_base=1, backoff_max=60)
+        self.retry_policy = retry_policy
+        self.running = False
+        self.active = 0
+        # Databases waiting for their changes to be fetched, as an
+        # ordered set
+        self._pending = collections.OrderedDict()
+        # Databases being fetched and whether they were updated
+        # meanwhile
+        self._fetching = {}
+        self._failures = {}
+        self._feed = None
+        self._feed_failures = 0
+        self._feed_lost = False
+        # Seq of the last update delivered by _db_updates
+        self._updates_seq = None
+        self._timeout = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._feed_lost = False
+        # Catch up with the changes made while we were away
+        for name in self.seqs:
+            self._pending[name] = True
+        self._follow()
+        self._run()
+
+    def stop(self):
+        self.running = False
+        if self._feed is not None:
+            self._feed.close()
+            self._feed = None
+        if self._timeout is not None:
+            self.server.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _follow(self):
+        self._timeout = None
+        if not self.running:
+            return
+
+        params = {'heartbeat': int(self.heartbeat * 1000)}
+        if self._updates_seq is not None:
+            params['since'] = self._updates_seq
+        # Without seqs in the updates (CouchDB 1.x), the databases
+        # updated while disconnected can't be told apart
+        catch_up = self._feed_lost and 'since' not in params
+        self._feed_lost = False
+
+        def _update(update):
+            if feed is not self._feed:
+                return
+            if update is None or update.error:
+                if update is not None:
+                    log.warning('Following _db_updates failed: %s',
+                                update.msg)
+                    if feed.received:
+                        # The connection worked, start backing off anew
+                        self._feed_failures = 0
+                    self._feed_failures += 1
+                self._feed = None
+                self._feed_lost = True
+                delay = 0
+                if self._feed_failures:
+                    delay = self.retry_policy.delay(self._feed_failures)
+                self._timeout = self.server.io_loop.add_timeout(
+                    time.time() + delay, self._follow)
+                return
+            self._feed_failures = 0
+            seq = update.get('seq', update.get('last_seq'))
+            if seq is not None:
+                self._updates_seq = seq
+            if 'db_name' in update:
+                self.updated(update['db_name'], update.get('type'))
+
+        self._feed = feed = self.server.db_updates(
+            _update, feed='continuous', **params)
+        if catch_up:
+            for name in list(self.seqs):
+                self.updated(name)
+
+    def updated(self, name, type='updated'):
+        """
+        Marks the database name updated, as _db_updates does.
+        """
+        if type == 'deleted':
+            self.seqs.pop(name, None)
+            self._pending.pop(name, None)
+            return
+        if name in self._fetching:
+            self._fetching[name] = True
+        else:
+            self._pending[name] = True
+            self._run()
+
+    def _run(self):
+        while (self.running and self._pending and
+               self.active < self.max_connections):
+            name, _ = self._pending.popitem(last=False)
+            self._fetch_changes(name)
+
+    def _fetch_changes(self, name):
+        self.active += 1
+        self._fetching[name] = False
+        db = Database(self.server, name)
+        db.priority = PRIORITY_BACKGROUND
+
+        def _changes(result):
+            self.active -= 1
+            again = self._fetching.pop(name)
+            if result.error:
+                if result.errno == trombi.errors.NOT_FOUND:
+                    self.seqs.pop(name, None)
+                    self._run()
+                    return
+                log.warning('Fetching changes of %s failed: %s',
+                            name, result.msg)
+                failures = self._failures[name] = \
+                    self._failures.get(name, 0) + 1
+                self.server.io_loop.add_timeout(
+                    time.time() + self.retry_policy.delay(failures),
+                    functools.partial(self.updated, name))
+                self._run()
+                return
+
+            self._failures.pop(name, None)
+            batch = ChangesBatch(result.content['results'])
+            batch.last_seq = result.content['last_seq']
+            self.seqs[name] = batch.last_seq
+            if self.limit is not None and len(batch) >= self.limit:
+                # There may be more
+                again = True
+            if again:
+                self._pending[name] = True
+            self._run()
+            if batch:
+                self.callback(name, batch)
+
+        params = {'since': self.seqs.get(name, self.default_since)}
+        if self.limit is not None:
+            params['limit'] = self.limit
+        db.changes(_changes, **params)
 
 
 VALID_DB_NAME = re.compile(r'^[a-z][a-z0-9_$()+-/]*$')
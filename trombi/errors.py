@@ -23,6 +23,7 @@
 
 # Collection of possible couchdb errors
 BAD_REQUEST = 400
+FORBIDDEN = 403
 CONFLICT = 409
 PRECONDITION_FAILED = 412
 NOT_FOUND = 404
@@ -30,6 +31,8 @@ SERVER_ERROR = 500
 
 # Non-http errors (or overloaded http 500 errors)
 INVALID_DATABASE_NAME = 51
+CIRCUIT_OPEN = 52
+QUEUE_FULL = 53
 
 errormap = {
     409: CONFLICT,
@@ -37,3 +40,74 @@ errormap = {
     404: NOT_FOUND,
     500: SERVER_ERROR
     }
+
+
+class TrombiException(Exception):
+    """
+    Raised by the futures returned by trombi when the operation fails.
+    """
+    def __init__(self, errno, msg):
+        super(TrombiException, self).__init__(errno, msg)
+        self.errno = errno
+        self.msg = msg
+
+    def __str__(self):
+        return 'CouchDB reported an error: %s (%d)' % (self.msg, self.errno)
+
+
+class BadRequest(TrombiException):
+    pass
+
+
+class Forbidden(TrombiException):
+    pass
+
+
+class NotFound(TrombiException):
+    pass
+
+
+class Conflict(TrombiException):
+    pass
+
+
+class PreconditionFailed(TrombiException):
+    pass
+
+
+class ServerError(TrombiException):
+    pass
+
+
+class ConnectionFailed(TrombiException):
+    pass
+
+
+class InvalidDatabaseName(TrombiException):
+    pass
+
+
+class CircuitOpen(TrombiException):
+    pass
+
+
+class QueueFull(TrombiException):
+    pass
+
+
+exceptions = {
+    BAD_REQUEST: BadRequest,
+    FORBIDDEN: Forbidden,
+    NOT_FOUND: NotFound,
+    CONFLICT: Conflict,
+    PRECONDITION_FAILED: PreconditionFailed,
+    SERVER_ERROR: ServerError,
+    599: ConnectionFailed,
+    INVALID_DATABASE_NAME: InvalidDatabaseName,
+    CIRCUIT_OPEN: CircuitOpen,
+    QUEUE_FULL: QueueFull,
+    }
+
+
+def exception_for(errno, msg):
+    return exceptions.get(errno, TrombiException)(errno, msg)